@@ -1,16 +1,38 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_from_directory, make_response
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_from_directory, make_response, abort
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, OperationalError
 from flask_socketio import SocketIO, emit, join_room, leave_room
+from socketio import PubSubManager
 from flask_wtf.csrf import CSRFProtect
 from werkzeug.middleware.proxy_fix import ProxyFix
-from datetime import datetime
+from datetime import datetime, timedelta
 import random
 import string
 import os
 import json
-from werkzeug.security import generate_password_hash, check_password_hash
-from PIL import Image, ImageDraw, ImageFont
+import time
+import threading
+import queue
+import atexit
+import re
+import bisect
+from functools import lru_cache
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 import io
+import gzip
+import shutil
+import hashlib
+import tempfile
+import mimetypes
+import subprocess
+import sys
+import socket
+import socketserver
+import click
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key'
@@ -20,7 +42,7 @@ csrf = CSRFProtect(app)
 # 配置信任代理，用于在宝塔等反向代理后面获取真实用户IP
 app.config['TRAP_HTTP_EXCEPTIONS'] = True
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(cors_allowed_origins="*")  # 读取配置后再绑定应用，见下方 socketio.init_app
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///chat.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'uploads'
@@ -28,9 +50,287 @@ app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'mov', 'avi', 'wmv'}
 app.config['RESET_DATABASE_ON_RESTART'] = True  # 控制重启程序是否重置数据库
 app.config['CHUNK_UPLOAD_FOLDER'] = 'temp_chunks'  # 分片临时存储目录
+app.config['SETTINGS_CACHE_TTL'] = 5  # 系统设置缓存有效期（秒），配置了 SOCKETIO_MESSAGE_QUEUE 时修改设置会立即通知其他进程，否则其他进程最多延迟这么久看到设置变更
+app.config['MESSAGE_WRITE_BEHIND'] = False  # 消息异步批量写入数据库（仅适用于单进程部署）
+app.config['MESSAGE_WRITE_BEHIND_BATCH_SIZE'] = 100  # 每批最多写入的消息数
+app.config['MESSAGE_WRITE_BEHIND_MAX_DELAY'] = 0.05  # 消息最长等待写入时间（秒）
+app.config['MESSAGE_WRITE_BEHIND_RETRIES'] = 3  # 批量写入失败时的重试次数，仍失败则逐条写入
+app.config['UNREAD_CACHE_SIZE'] = 10000  # 内存中缓存未读消息的用户数上限，超出时去掉最久没有用到的用户，下次需要时重新从数据库加载
+app.config['MESSAGE_PAGE_SIZE'] = 50  # 每次加载的历史消息条数
+app.config['MESSAGE_PAGE_SIZE_MAX'] = 200  # 每次加载的历史消息条数上限
+app.config['MESSAGE_ARCHIVE_AFTER_DAYS'] = None  # 用户最后一条消息超过该天数且没有未读消息时，后台清理把对话移到归档文件，None 表示不归档
+app.config['MESSAGE_ARCHIVE_FOLDER'] = 'message_archive'  # 归档文件目录，每天一个只追加的 gzip 压缩 JSONL 文件
+app.config['MESSAGE_ARCHIVE_BATCH_SIZE'] = 100  # 每次写入归档文件和提交数据库的对话数
+app.config['MERGE_WORKERS'] = 2  # 后台合并分片的线程数
+app.config['MERGE_BUFFER_SIZE'] = 1024 * 1024  # 无法使用内核复制时的合并缓冲区大小
+app.config['CHUNK_UPLOAD_DIRECT_WRITE'] = True  # 分片直接写入目标文件的对应位置，合并时只需重命名
+app.config['UPLOAD_CHUNK_SIZE'] = 5 * 1024 * 1024  # 客户端未提供 chunkSize 时使用的分片大小
+app.config['UPLOAD_MAX_CHUNK_SIZE'] = 64 * 1024 * 1024  # 客户端声明的分片大小上限
+app.config['UPLOAD_MAX_FILE_SIZE'] = 1024 * 1024 * 1024  # 分片上传的文件大小上限，在创建上传任务前检查
+app.config['UPLOAD_MAX_CHUNKS'] = 10000  # 单个上传任务的分片数上限，限制分片位图的大小
+app.config['UPLOAD_MAX_INFLIGHT_CHUNKS'] = 16  # 全局同时写入的分片数上限
+app.config['UPLOAD_MAX_INFLIGHT_CHUNKS_PER_SESSION'] = 4  # 单个上传任务同时写入的分片数上限
+app.config['UPLOAD_RETRY_AFTER'] = 1  # 超出上限时建议客户端重试的等待秒数
+app.config['UPLOAD_HASH_BLOCK_SIZE'] = 1024 * 1024  # 内容哈希的分块大小，分片大小为其整数倍时边上传边计算哈希
+app.config['UPLOAD_BLOB_GRACE_PERIOD'] = 300  # 文件最近一次上传后的保护时间（秒），期间引用数为零也不删除
+app.config['IMAGE_VARIANT_FOLDER'] = 'image_variants'  # 图片缩略图缓存目录
+app.config['IMAGE_VARIANT_WIDTHS'] = (400, 1200)  # 生成的缩略图尺寸（宽高上限），/uploads/<name>?w= 取不小于请求值的最小尺寸
+app.config['IMAGE_VARIANT_QUALITY'] = 80  # 缩略图 WebP 质量
+app.config['IMAGE_VARIANT_WORKERS'] = 2  # 后台生成缩略图的线程数
+app.config['FFPROBE_PATH'] = 'ffprobe'  # 视频探测工具，找不到时跳过视频信息提取
+app.config['FFMPEG_PATH'] = 'ffmpeg'  # 视频封面提取工具，找不到时只记录时长和尺寸
+app.config['MEDIA_PROBE_WORKERS'] = 1  # 后台提取视频信息的线程数
+app.config['MEDIA_PROBE_TIMEOUT'] = 60  # 单次调用 ffprobe/ffmpeg 的超时时间（秒）
+app.config['VIDEO_POSTER_WIDTH'] = 800  # 视频封面的最大宽度
+app.config['GC_INTERVAL'] = 3600  # 后台清理过期分片和无引用上传文件的间隔（秒），0 表示不启动
+app.config['UPLOAD_SESSION_TTL'] = 24 * 3600  # 分片上传任务最后收到分片后保留的时间（秒）
+app.config['GC_DELETE_RATE'] = 20  # 清理时每秒最多删除的文件或目录数，避免与正常请求争抢磁盘
+app.config['CAPTCHA_POOL_SIZE'] = 200  # 预先渲染的验证码数量
+app.config['USER_AGENT_REQUIRE_BROWSER_SIGNATURE'] = False  # 启用 User Agent 过滤时，同时拒绝不包含常见浏览器标识（mozilla、webkit、chrome 等）的 User Agent
+app.config['UPLOAD_CACHE_MAX_AGE'] = 365 * 24 * 3600  # 上传文件的浏览器缓存时间（秒），文件名由内容决定，内容不会变化
+app.config['UPLOAD_SENDFILE_MODE'] = None  # 由前端代理发送文件：None、'x-sendfile'（Apache/lighttpd）或 'x-accel-redirect'（Nginx）
+app.config['UPLOAD_ACCEL_REDIRECT_PREFIX'] = '/_protected/'  # X-Accel-Redirect 模式下 Nginx internal location 的前缀，后接上传目录名和文件名
+app.config['SOCKETIO_MESSAGE_QUEUE'] = None  # 多进程部署时转发房间消息的消息队列：redis://、amqp://、kafka://、zmq+tcp:// 或本机中转 local:///path/to/relay.sock
+app.config['SOCKETIO_ASYNC_MODE'] = None  # Socket.IO 并发模式，None 表示入口已用 gevent 打补丁（server.py）时使用 gevent，否则使用线程
+app.config['BLOCKING_POOL_SIZE'] = 10  # gevent 模式下执行数据库调用的原生线程数
+app.config['CONTENT_CACHE_TTL'] = None  # 自动回复和聊天页面内容缓存有效期（秒），None 表示只在修改时失效；配置了 SOCKETIO_MESSAGE_QUEUE 时修改会立即通知其他进程，没有消息队列的多进程部署设置为几秒
+app.config['SQLITE_TUNING'] = True  # SQLite 数据库启用下面的 PRAGMA 和固定大小的连接池，False 恢复 SQLite 默认的回滚日志模式
+app.config['SQLITE_PRAGMAS'] = {  # SQLITE_TUNING 开启时每个新连接执行的 PRAGMA
+    'journal_mode': 'WAL',  # 写入时读连接继续读取提交前的数据，读写互不阻塞
+    'synchronous': 'NORMAL',  # WAL 模式下只在检查点同步磁盘，断电可能丢失最近提交的事务，但不会损坏数据库
+    'busy_timeout': 5000,  # 等待其他连接释放写锁的毫秒数
+    'cache_size': -64000,  # 每个连接的页缓存大小，负数表示 KB
+    'mmap_size': 256 * 1024 * 1024,  # 通过内存映射读取数据库文件的字节数
+    'temp_store': 'MEMORY',  # 排序和临时表使用内存
+}
+app.config['SQLITE_POOL_SIZE'] = 20  # SQLITE_TUNING 开启时连接池保持的连接数，不创建用完即关闭的溢出连接
+app.config['DATABASE_POOL_SIZE'] = 10  # PostgreSQL/MySQL 等服务端数据库连接池保持的连接数
+app.config['DATABASE_MAX_OVERFLOW'] = 10  # 并发超过连接池大小时额外创建的临时连接数
+app.config['DATABASE_POOL_TIMEOUT'] = 30  # 连接都在使用时等待空闲连接的秒数
+app.config['DATABASE_POOL_PRE_PING'] = True  # 取出连接时先检查连接是否可用，数据库重启或网络中断后自动重连
+app.config['DATABASE_POOL_RECYCLE'] = 1800  # 连接建立超过该秒数后重新建立，避免被数据库或防火墙的空闲超时断开，-1 表示不重建
+# 环境变量 FLASK_<配置项> 覆盖上面的配置，值按 JSON 解析，例如 FLASK_RESET_DATABASE_ON_RESTART=false
+app.config.from_prefixed_env()
+
+# 本机消息中转：各进程通过 Unix 套接字连接，每行一条 JSON 消息，
+# 转发给其他发送过订阅行的连接；只发送不接收的连接（例如外部进程推送）不订阅，避免写满它的接收缓冲区
+MESSAGE_RELAY_SUBSCRIBE = b'SUBSCRIBE\n'
+
+class MessageRelay(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    
+    def __init__(self, path):
+        self.subscribers = set()
+        self.subscribers_lock = threading.Lock()
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, MessageRelayHandler)
+
+class MessageRelayHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        relay = self.server
+        try:
+            for line in self.rfile:
+                if line == MESSAGE_RELAY_SUBSCRIBE:
+                    with relay.subscribers_lock:
+                        relay.subscribers.add(self.wfile)
+                    continue
+                with relay.subscribers_lock:
+                    for wfile in list(relay.subscribers):
+                        if wfile is self.wfile:
+                            continue
+                        try:
+                            wfile.write(line)
+                        except OSError:
+                            relay.subscribers.discard(wfile)
+        finally:
+            with relay.subscribers_lock:
+                relay.subscribers.discard(self.wfile)
+
+# 通过本机消息中转在进程之间同步 Socket.IO 房间消息，用于单机多进程部署和测试
+class LocalSocketManager(PubSubManager):
+    name = 'local'
+    
+    def __init__(self, url, channel='flask-socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = url[len('local://'):]
+        self.publish_socket = None
+        self.publish_lock = threading.Lock()
+    
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    
+    def _publish(self, data):
+        line = (json.dumps({'channel': self.channel, 'data': data}) + '\n').encode()
+        with self.publish_lock:
+            # 中转重启后连接会断开，重连一次
+            for _ in range(2):
+                try:
+                    if self.publish_socket is None:
+                        self.publish_socket = self._connect()
+                    self.publish_socket.sendall(line)
+                    return
+                except OSError:
+                    if self.publish_socket is not None:
+                        self.publish_socket.close()
+                        self.publish_socket = None
+        self._get_logger().error('Cannot publish to message relay %s', self.path)
+    
+    def _listen(self):
+        while True:
+            try:
+                sock = self._connect()
+                sock.sendall(MESSAGE_RELAY_SUBSCRIBE)
+            except OSError:
+                time.sleep(1)
+                continue
+            # 发布也使用订阅连接，中转不会把本进程发布的消息再发回来
+            with self.publish_lock:
+                if self.publish_socket is not None:
+                    self.publish_socket.close()
+                self.publish_socket = sock
+            with sock.makefile('rb') as reader:
+                try:
+                    for line in reader:
+                        message = json.loads(line)
+                        if message.get('channel') == self.channel:
+                            yield message['data']
+                except OSError:
+                    pass
+            with self.publish_lock:
+                if self.publish_socket is sock:
+                    self.publish_socket = None
+            sock.close()
+            time.sleep(1)
+
+# 根据配置选择 Socket.IO 的消息队列，local:// 使用本机消息中转，其他地址由 Flask-SocketIO 选择对应的实现
+def get_socketio_queue_options(url):
+    if not url:
+        return {}
+    if url.startswith('local://'):
+        return {'client_manager': LocalSocketManager(url)}
+    return {'message_queue': url}
+
+# 选择 Socket.IO 并发模式：没有打补丁时 gevent 的协程无法切换，只能使用线程模式
+def get_socketio_async_mode():
+    if app.config['SOCKETIO_ASYNC_MODE']:
+        return app.config['SOCKETIO_ASYNC_MODE']
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('socket'):
+        return 'gevent'
+    return 'threading'
+
+socketio.init_app(app, async_mode=get_socketio_async_mode(),
+                  **get_socketio_queue_options(app.config['SOCKETIO_MESSAGE_QUEUE']))
+
+# 进程内缓存的跨进程失效：配置了消息队列时，失效通知作为发往专用房间的事件经消息队列广播，
+# 其他进程在消息队列的监听线程中截获该事件并调用注册的失效函数，不会推送给客户端
+CACHE_INVALIDATION_EVENT = 'cache_invalidation'
+_cache_invalidation_handlers = {}
+
+# 注册缓存失效函数，其他进程发布同名缓存的失效通知时调用
+def on_cache_invalidation(name):
+    def decorator(func):
+        _cache_invalidation_handlers[name] = func
+        return func
+    return decorator
+
+# 通知其他进程使缓存失效，没有配置消息队列时只有本进程的缓存，不需要发布
+def publish_cache_invalidation(name, *args):
+    manager = socketio.server.manager
+    if isinstance(manager, PubSubManager):
+        manager.emit(CACHE_INVALIDATION_EVENT, {'name': name, 'args': list(args)},
+                     namespace='/', room=CACHE_INVALIDATION_EVENT)
+
+# 截获消息队列中的缓存失效事件，本进程发布的事件在发布前已经失效过，直接跳过
+def install_cache_invalidation_listener(manager):
+    handle_emit = manager._handle_emit
+    
+    def _handle_emit(message):
+        if message.get('event') != CACHE_INVALIDATION_EVENT:
+            return handle_emit(message)
+        if message.get('host_id') == manager.host_id:
+            return
+        data = message['data'][0]
+        handler = _cache_invalidation_handlers.get(data['name'])
+        if handler is not None:
+            handler(*data['args'])
+    
+    manager._handle_emit = _handle_emit
+
+if isinstance(socketio.server.manager, PubSubManager):
+    install_cache_invalidation_listener(socketio.server.manager)
+
+# 开始接收其他进程的失效通知。消息队列的监听线程默认在第一个客户端连接时才启动，
+# 还没有客户端连接的进程也会缓存数据，在第一次加载缓存时启动
+def start_cache_invalidation_listener():
+    server = socketio.server
+    if isinstance(server.manager, PubSubManager) and not server.manager_initialized:
+        server.manager_initialized = True
+        server.manager.initialize()
+
+# gevent 模式下 sqlite3 等 C 扩展的阻塞调用会卡住整个事件循环，放到原生线程池中执行
+if socketio.async_mode == 'gevent':
+    from gevent.threadpool import ThreadPool
+    _blocking_pool = ThreadPool(app.config['BLOCKING_POOL_SIZE'])
+else:
+    _blocking_pool = None
+
+# 执行阻塞调用并返回结果，gevent 模式下当前协程等待线程池执行完成，其他连接照常处理。
+# 线程中使用独立的应用上下文，数据库连接在同一个线程中取出和归还
+def run_blocking(func, *args):
+    if _blocking_pool is None:
+        return func(*args)
+    return _blocking_pool.apply(_run_in_app_context, (func,) + args)
+
+def _run_in_app_context(func, *args):
+    with app.app_context():
+        return func(*args)
+
+# 创建后台任务线程池，gevent 模式下使用原生线程，图片处理和文件合并不会阻塞事件循环
+def create_executor(max_workers):
+    if socketio.async_mode == 'gevent':
+        from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+        return NativeThreadPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+# 根据数据库地址选择连接池配置。SQLite 文件数据库的页缓存属于单个连接，保持固定数量的长期连接，并发超过连接数时等待空闲连接；
+# 内存数据库每个线程只有一个连接，使用 SQLAlchemy 的默认连接池；服务端数据库按 DATABASE_POOL_* 配置
+def get_engine_options(uri):
+    url = make_url(uri)
+    if url.get_backend_name() == 'sqlite':
+        if app.config['SQLITE_TUNING'] and url.database not in (None, '', ':memory:'):
+            return {'pool_size': app.config['SQLITE_POOL_SIZE'], 'max_overflow': 0}
+        return {}
+    return {
+        'pool_size': app.config['DATABASE_POOL_SIZE'],
+        'max_overflow': app.config['DATABASE_MAX_OVERFLOW'],
+        'pool_timeout': app.config['DATABASE_POOL_TIMEOUT'],
+        'pool_pre_ping': app.config['DATABASE_POOL_PRE_PING'],
+        'pool_recycle': app.config['DATABASE_POOL_RECYCLE'],
+    }
+
+app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', get_engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
 
 db = SQLAlchemy(app)
 
+# SQLite 连接参数只对当前连接有效，每个新连接建立时执行一次
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+with app.app_context():
+    if app.config['SQLITE_TUNING'] and db.engine.dialect.name == 'sqlite':
+        db.event.listen(db.engine, 'connect', apply_sqlite_pragmas)
+
 # 数据库模型
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -40,26 +340,39 @@ class User(db.Model):
     user_agent = db.Column(db.String(255))
     remark = db.Column(db.Text, default='')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_read_message_id = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # 管理员已读到的最新消息ID
     messages = db.relationship('Message', backref='user', lazy=True)
 
+# 消息主键序列，只在支持序列的数据库中创建，与 PostgreSQL 自增主键默认的序列同名
+message_id_seq = db.Sequence('message_id_seq')
+
 class Message(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, message_id_seq, primary_key=True)
     user_id = db.Column(db.String(50), db.ForeignKey('user.user_id'), nullable=False)
     content = db.Column(db.Text, nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
     is_read = db.Column(db.Boolean, default=False)
     message_type = db.Column(db.String(20), default='text')  # text, image, video
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # 按用户分页查询消息列表
+        db.Index('ix_message_user_id_id', 'user_id', 'id'),
+        # 按用户查询最新消息时间
+        db.Index('ix_message_user_id_created_at', 'user_id', 'created_at'),
+        # 按用户统计已读位置之后的未读消息
+        db.Index('ix_message_user_id_is_admin_id', 'user_id', 'is_admin', 'id'),
+    )
 
 class SystemSetting(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     key = db.Column(db.String(50), unique=True, nullable=False)
-    value = db.Column(db.String(255), nullable=False)
+    value = db.Column(db.Text, nullable=False)  # 屏蔽的 User Agent 列表可能较长
 
 class Admin(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
-    password = db.Column(db.String(100), nullable=False)
+    password = db.Column(db.String(255), nullable=False)  # scrypt 密码哈希约 160 个字符
 
 class AutoReply(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -81,6 +394,51 @@ class WelcomeMessage(db.Model):
     message_type = db.Column(db.String(20), default='text', nullable=False)  # text, image, video
     order_index = db.Column(db.Integer, default=0, nullable=False)  # 排序索引
 
+class UploadSession(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    file_id = db.Column(db.String(100), unique=True, nullable=False)
+    file_name = db.Column(db.String(255), nullable=False)
+    file_size = db.Column(db.BigInteger, nullable=False)
+    file_type = db.Column(db.String(100))
+    total_chunks = db.Column(db.Integer, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    received_chunks = db.Column(db.LargeBinary, nullable=False)  # 已收到分片的位图，每个分片一位
+    received_count = db.Column(db.Integer, default=0, nullable=False)  # 已收到的分片数，同时作为并发更新的版本号
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UploadBlob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(100), unique=True, nullable=False)  # 内容哈希加扩展名
+    content_hash = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)  # 引用该文件的消息、打招呼语句、自动回复和常见问题数
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_stored_at = db.Column(db.DateTime, default=datetime.utcnow)  # 最近一次上传相同内容的时间
+    media_width = db.Column(db.Integer)  # 视频宽度，后台探测完成后填写
+    media_height = db.Column(db.Integer)  # 视频高度
+    media_duration = db.Column(db.Float)  # 视频时长（秒）
+    media_poster = db.Column(db.String(120))  # 视频封面文件名，位于缩略图缓存目录
+
+# 归档的对话片段：一个用户一次归档的全部消息，压缩后作为一个独立的 gzip 成员追加到当天的归档文件
+class MessageArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String(50), nullable=False)
+    archive_file = db.Column(db.String(100), nullable=False)  # 归档文件名，位于 MESSAGE_ARCHIVE_FOLDER
+    offset = db.Column(db.BigInteger, nullable=False)  # gzip 成员在文件中的起始位置
+    length = db.Column(db.Integer, nullable=False)  # gzip 成员的字节数
+    first_message_id = db.Column(db.Integer, nullable=False)
+    last_message_id = db.Column(db.Integer, nullable=False)
+    message_count = db.Column(db.Integer, nullable=False)
+    last_message_at = db.Column(db.DateTime, nullable=False)  # 片段中最新消息的时间，管理员用户列表按它排序
+    media_references = db.Column(db.Text, default='{}', nullable=False)  # 片段中引用的上传文件和次数（JSON），归档不改变文件引用数
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # 按用户从新到旧读取归档片段
+        db.Index('ix_message_archive_user_id_last_message_id', 'user_id', 'last_message_id'),
+    )
+
 # 生成随机用户ID
 def generate_user_id():
     return 'user_' + ''.join(random.choices(string.ascii_letters + string.digits, k=10))
@@ -90,87 +448,135 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-# 生成唯一的文件名
-def generate_unique_filename(filename):
+# 内容寻址的文件名：内容哈希加原扩展名
+def content_addressed_filename(content_hash, filename):
     ext = filename.rsplit('.', 1)[1].lower()
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=20)) + '.' + ext
+    return content_hash + '.' + ext
+
+# 设备类型关键词，一次正则扫描取出所有命中的关键词
+_DEVICE_KEYWORD_PATTERN = re.compile(r'windows phone|mobile|android|iphone|ipad|ipod|blackberry|windows|macintosh|linux|chromeos')
+_MOBILE_KEYWORDS = {'mobile', 'android', 'iphone', 'ipad', 'ipod', 'blackberry', 'windows phone'}
+_DESKTOP_KEYWORDS = {'windows', 'macintosh', 'linux', 'chromeos'}
+# User Agent 分类结果缓存的最大条目数
+USER_AGENT_CACHE_SIZE = 4096
 
 # 根据用户代理字符串检测设备类型
+@lru_cache(maxsize=USER_AGENT_CACHE_SIZE)
 def detect_device_type(user_agent):
     if not user_agent:
         return '未知设备'
     
-    user_agent = user_agent.lower()
+    keywords = set(_DEVICE_KEYWORD_PATTERN.findall(user_agent.lower()))
     
     # 移动设备
-    if any(device in user_agent for device in ['mobile', 'android', 'iphone', 'ipad', 'ipod', 'blackberry', 'windows phone']):
-        if 'android' in user_agent:
+    if keywords & _MOBILE_KEYWORDS:
+        if 'android' in keywords:
             return 'Android手机'
-        elif 'iphone' in user_agent:
+        elif 'iphone' in keywords:
             return 'iPhone'
-        elif 'ipad' in user_agent:
+        elif 'ipad' in keywords:
             return 'iPad'
         else:
             return '移动设备'
     
     # 桌面设备
-    elif any(browser in user_agent for browser in ['windows', 'macintosh', 'linux', 'chromeos']):
-        if 'windows' in user_agent:
+    elif keywords & _DESKTOP_KEYWORDS:
+        if 'windows' in keywords:
             return 'Windows桌面'
-        elif 'macintosh' in user_agent:
+        elif 'macintosh' in keywords:
             return 'Mac桌面'
-        elif 'linux' in user_agent:
+        elif 'linux' in keywords:
             return 'Linux桌面'
-        elif 'chromeos' in user_agent:
-            return 'Chrome OS'
         else:
-            return '桌面设备'
+            return 'Chrome OS'
     
     # 其他设备
     else:
         return '其他设备'
 
+# 将被阻止的关键词列表编译为一个正则，设置变更后自动重新编译
+@lru_cache(maxsize=8)
+def compile_blocked_user_agents(blocked_user_agents):
+    keywords = {keyword.strip().lower() for keyword in blocked_user_agents.split(',')}
+    keywords.discard('')
+    if not keywords:
+        return None
+    return re.compile('|'.join(re.escape(keyword) for keyword in keywords))
+
+# 检查 User Agent 是否包含被阻止的关键词
+@lru_cache(maxsize=USER_AGENT_CACHE_SIZE)
+def is_blocked_user_agent(blocked_user_agents, user_agent):
+    pattern = compile_blocked_user_agents(blocked_user_agents)
+    return pattern is not None and pattern.search(user_agent.lower()) is not None
+
 # 验证 User Agent 是否正常
 def is_valid_user_agent(user_agent):
     if not user_agent:
         return False
     
-    user_agent_lower = user_agent.lower()
-    
     # 检查是否启用 User Agent 过滤
     if get_system_setting('enable_user_agent_filter') != 'true':
         return True
     
-    # 获取被阻止的 User Agent 关键词
-    blocked_keywords = get_system_setting('blocked_user_agents', '').split(',')
-    
     # 检查是否包含被阻止的关键词
-    for keyword in blocked_keywords:
-        keyword = keyword.strip().lower()
-        if keyword and keyword in user_agent_lower:
-            return False
+    if is_blocked_user_agent(get_system_setting('blocked_user_agents', ''), user_agent):
+        return False
     
     # 检查 User Agent 是否太短（少于10个字符，可能是爬虫）
     if len(user_agent) < 10:
         return False
     
-    # 检查是否包含常见的浏览器标识（可选，更严格的验证）
+    # 检查是否包含常见的浏览器标识（可选，更严格的验证，由 USER_AGENT_REQUIRE_BROWSER_SIGNATURE 控制）
     # 如果 User Agent 不包含任何常见浏览器标识，可能是爬虫
-    browser_signatures = ['mozilla', 'webkit', 'gecko', 'chrome', 'safari', 'firefox', 'edge', 'opera', 'trident']
-    has_browser_signature = any(sig in user_agent_lower for sig in browser_signatures)
-    
-    # 如果没有浏览器标识，但也不是空字符串，可能需要更严格的检查
-    # 这里我们选择宽松的策略：只要不包含被阻止的关键词，就允许访问
-    # 如果需要更严格的验证，可以取消下面的注释
-    # if not has_browser_signature:
-    #     return False
+    if app.config['USER_AGENT_REQUIRE_BROWSER_SIGNATURE']:
+        browser_signatures = ['mozilla', 'webkit', 'gecko', 'chrome', 'safari', 'firefox', 'edge', 'opera', 'trident']
+        if not any(sig in user_agent.lower() for sig in browser_signatures):
+            return False
     
     return True
 
+# 系统设置缓存：一次加载全部设置，修改时失效并通知其他进程
+_settings_cache = {'values': None, 'loaded_at': 0}
+_settings_cache_lock = threading.Lock()
+settings_cache_stats = {'hits': 0, 'misses': 0, 'reloads': 0, 'invalidations': 0}
+
+# 加载全部系统设置到缓存
+def _load_system_settings():
+    with _settings_cache_lock:
+        values = _settings_cache['values']
+        if values is not None and time.time() - _settings_cache['loaded_at'] < app.config['SETTINGS_CACHE_TTL']:
+            return values
+        start_cache_invalidation_listener()
+        values = {setting.key: setting.value for setting in SystemSetting.query.all()}
+        _settings_cache['values'] = values
+        _settings_cache['loaded_at'] = time.time()
+        settings_cache_stats['reloads'] += 1
+        return values
+
+# 清空本进程的系统设置缓存，其他进程修改设置时也会调用
+@on_cache_invalidation('settings')
+def clear_settings_cache():
+    with _settings_cache_lock:
+        _settings_cache['values'] = None
+        settings_cache_stats['invalidations'] += 1
+
+# 使系统设置缓存失效，并通知其他进程
+def invalidate_settings_cache():
+    clear_settings_cache()
+    publish_cache_invalidation('settings')
+
 # 获取系统设置
 def get_system_setting(key, default='false'):
-    setting = SystemSetting.query.filter_by(key=key).first()
-    return setting.value if setting else default
+    with _settings_cache_lock:
+        values = _settings_cache['values']
+        if values is not None and time.time() - _settings_cache['loaded_at'] < app.config['SETTINGS_CACHE_TTL']:
+            settings_cache_stats['hits'] += 1
+        else:
+            settings_cache_stats['misses'] += 1
+            values = None
+    if values is None:
+        values = _load_system_settings()
+    return values.get(key, default)
 
 # 更新系统设置
 def update_system_setting(key, value):
@@ -181,79 +587,424 @@ def update_system_setting(key, value):
         setting = SystemSetting(key=key, value=value)
         db.session.add(setting)
     db.session.commit()
-
-# 初始化数据库
-with app.app_context():
-    # 检查是否需要重置数据库
-    if app.config['RESET_DATABASE_ON_RESTART']:
-        # 先删除所有表
-        db.drop_all()
-        # 重新创建所有表
-        db.create_all()
-        # 添加默认管理员
-        admin = Admin(username='admin', password=generate_password_hash('admin123'))
-        db.session.add(admin)
-        # 添加默认常见问题
-        questions = [
-            {'question': '如何注册账号？', 'content': '您可以点击首页的注册按钮，填写相关信息即可注册。', 'message_type': 'text', 'order_index': 0},
-            {'question': '如何找回密码？', 'content': '您可以点击登录页面的忘记密码，按照提示操作即可找回。', 'message_type': 'text', 'order_index': 1},
-            {'question': '客服工作时间？', 'content': '我们的客服工作时间是周一至周日 9:00-21:00。', 'message_type': 'text', 'order_index': 2}
-        ]
-        for q in questions:
-            cq = CommonQuestion(question=q['question'], content=q['content'], message_type=q['message_type'], order_index=q['order_index'])
-            db.session.add(cq)
-        # 添加默认关键词自动回复
-        auto_replies = [
-            {'keyword': '你好', 'content': '你好！请问有什么可以帮助您的？', 'message_type': 'text', 'order_index': 0},
-            {'keyword': '谢谢', 'content': '不客气，很高兴为您服务！', 'message_type': 'text', 'order_index': 1},
-            {'keyword': '再见', 'content': '再见，祝您生活愉快！', 'message_type': 'text', 'order_index': 2}
-        ]
-        for ar in auto_replies:
-            ar_obj = AutoReply(keyword=ar['keyword'], content=ar['content'], message_type=ar['message_type'], order_index=ar['order_index'])
-            db.session.add(ar_obj)
-        # 添加默认系统设置
-        settings = [
-            {'key': 'allow_user_images', 'value': 'true'},
-            {'key': 'allow_user_videos', 'value': 'true'},
-            {'key': 'chat_path', 'value': '/'},
-            {'key': 'enable_user_agent_filter', 'value': 'false'},
-            {'key': 'blocked_user_agents', 'value': 'bot,crawler,spider,scraper,python-requests,curl,wget'}
-        ]
-        for setting in settings:
-            ss = SystemSetting(key=setting['key'], value=setting['value'])
-            db.session.add(ss)
+    invalidate_settings_cache()
+
+# Aho–Corasick 多关键词匹配器，一次扫描找出文本中优先级最高的关键词
+class KeywordMatcher:
+    def __init__(self, items):
+        # items 按优先级从高到低排列，每项为 (关键词, 值)
+        self.values = [value for _, value in items]
+        no_match = len(self.values)
+        self.goto = [{}]
+        self.fail = [0]
+        self.best = [no_match]
+        
+        # 构建字典树，每个节点记录以该节点结尾的最高优先级
+        for rank, (keyword, _) in enumerate(items):
+            node = 0
+            for char in keyword:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.best.append(no_match)
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.best[node] = min(self.best[node], rank)
         
-        # 添加默认打招呼语句
+        # 广度优先构建失败指针，并沿失败指针合并优先级
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.best[child] = min(self.best[child], self.best[self.fail[child]])
+                queue.append(child)
+    
+    # 返回文本中包含的优先级最高的关键词对应的值，没有则返回 None
+    def search(self, text):
+        result = self.best[0]
+        node = 0
+        for char in text:
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            if self.best[node] < result:
+                result = self.best[node]
+                if result == 0:
+                    break
+        return self.values[result] if result < len(self.values) else None
+
+# 自动回复引擎缓存：常见问题精确匹配字典和关键词匹配器，管理员修改后失效
+_auto_reply_engine = {'common_questions': None, 'auto_replies': None, 'loaded_at': 0}
+auto_reply_engine_stats = {'rebuilds': 0, 'invalidations': 0}
+
+# 聊天页面内容缓存：常见问题列表和打招呼语句，修改后失效
+_page_content_cache = {'common_questions': None, 'welcome_messages': None, 'loaded_at': 0}
+page_content_cache_stats = {'rebuilds': 0, 'invalidations': 0}
+
+# 内容缓存是否超过有效期，多进程部署时其他进程的修改只能通过过期重新加载
+def is_content_cache_expired(cache):
+    ttl = app.config['CONTENT_CACHE_TTL']
+    return ttl is not None and time.time() - cache['loaded_at'] >= ttl
+
+# 获取自动回复引擎，缓存失效时重新构建
+def get_auto_reply_engine():
+    common_questions = _auto_reply_engine['common_questions']
+    auto_replies = _auto_reply_engine['auto_replies']
+    if common_questions is None or auto_replies is None or is_content_cache_expired(_auto_reply_engine):
+        start_cache_invalidation_listener()
+        common_questions = {}
+        for cq in CommonQuestion.query.order_by(CommonQuestion.order_index).all():
+            common_questions.setdefault(cq.question, {'content': cq.content, 'message_type': cq.message_type})
+        auto_replies = KeywordMatcher([
+            (reply.keyword, {'content': reply.content, 'message_type': reply.message_type})
+            for reply in AutoReply.query.order_by(AutoReply.order_index).all()
+        ])
+        _auto_reply_engine['common_questions'] = common_questions
+        _auto_reply_engine['auto_replies'] = auto_replies
+        _auto_reply_engine['loaded_at'] = time.time()
+        auto_reply_engine_stats['rebuilds'] += 1
+    return common_questions, auto_replies
+
+# 清空本进程的自动回复引擎缓存，其他进程修改常见问题或自动回复时也会调用
+@on_cache_invalidation('auto_reply')
+def clear_auto_reply_engine():
+    _auto_reply_engine['common_questions'] = None
+    _auto_reply_engine['auto_replies'] = None
+    auto_reply_engine_stats['invalidations'] += 1
+
+# 使自动回复引擎缓存失效，并通知其他进程
+def invalidate_auto_reply_engine():
+    clear_auto_reply_engine()
+    publish_cache_invalidation('auto_reply')
+
+# 获取聊天页面的常见问题列表和打招呼语句，缓存失效时重新查询
+def get_page_content():
+    common_questions = _page_content_cache['common_questions']
+    welcome_messages = _page_content_cache['welcome_messages']
+    if common_questions is None or welcome_messages is None or is_content_cache_expired(_page_content_cache):
+        start_cache_invalidation_listener()
+        common_questions = [
+            {'id': cq.id, 'question': cq.question, 'answer': cq.content}
+            for cq in CommonQuestion.query.all()
+        ]
         welcome_messages = [
-            {'content': '您好！欢迎使用我们的客服系统，请问有什么可以帮助您的？', 'message_type': 'text', 'order_index': 0},
-            {'content': '我们的工作时间是周一至周日 9:00-21:00', 'message_type': 'text', 'order_index': 1}
+            {'content': msg.content, 'message_type': msg.message_type}
+            for msg in WelcomeMessage.query.order_by(WelcomeMessage.order_index).all()
         ]
-        for msg in welcome_messages:
-            wm = WelcomeMessage(content=msg['content'], message_type=msg['message_type'], order_index=msg['order_index'])
-            db.session.add(wm)
+        _page_content_cache['common_questions'] = common_questions
+        _page_content_cache['welcome_messages'] = welcome_messages
+        _page_content_cache['loaded_at'] = time.time()
+        page_content_cache_stats['rebuilds'] += 1
+    return common_questions, welcome_messages
+
+# 清空本进程的聊天页面内容缓存，其他进程修改常见问题或打招呼语句时也会调用
+@on_cache_invalidation('page_content')
+def clear_page_content_cache():
+    _page_content_cache['common_questions'] = None
+    _page_content_cache['welcome_messages'] = None
+    page_content_cache_stats['invalidations'] += 1
+
+# 使聊天页面内容缓存失效，并通知其他进程
+def invalidate_page_content_cache():
+    clear_page_content_cache()
+    publish_cache_invalidation('page_content')
+
+# 数据库迁移：create_all 不会修改已存在的表，这里补建后续版本新增的字段和索引
+def migrate_database():
+    inspector = db.inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    ddl_compiler = db.engine.dialect.ddl_compiler(db.engine.dialect, None)
+    added_columns = set()
+    for table in db.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            sql = f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {column.type.compile(db.engine.dialect)}'
+            default = ddl_compiler.get_column_default_string(column)
+            if default is not None:
+                sql += f' DEFAULT {default}'
+            db.session.execute(db.text(sql))
+            added_columns.add((table.name, column.name))
+        db.session.commit()
         
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+    
+    # 新增已读位置字段时，根据已有的 is_read 标记设置已读位置
+    if ('user', 'last_read_message_id') in added_columns:
+        db.session.execute(db.update(User).values(last_read_message_id=db.select(
+            db.func.coalesce(db.func.max(Message.id), 0)
+        ).where(Message.user_id == User.user_id, Message.is_admin == False, Message.is_read == True).scalar_subquery()))
         db.session.commit()
+
+# 用户在管理员已读位置之后发送的消息数查询
+def unread_messages_query(user_id):
+    return db.session.query(db.func.count(Message.id)) \
+        .join(User, User.user_id == Message.user_id) \
+        .filter(Message.user_id == user_id, Message.is_admin == False, Message.id > User.last_read_message_id)
+
+# 统计用户在管理员已读位置之后发送的消息数
+def count_unread_messages(user_id):
+    return unread_messages_query(user_id).scalar()
+
+# 未读消息缓存：用户ID -> 管理员已读位置之后的用户消息ID（升序）。第一次需要时从数据库和写入队列加载，
+# 之后保存的用户消息加入列表，已读位置移动时去掉不超过它的ID，未读数就是列表长度，不需要每条消息统计一次。
+# 按最近使用顺序保存，最多 UNREAD_CACHE_SIZE 个用户。数据库查询在锁外进行，加载期间保存的消息和移动的已读位置
+# 记在该用户的加载标记中，加载完成后在锁内合并；加载期间缓存失效时丢弃标记，结果只用于本次返回，不写入缓存
+_unread_message_ids = OrderedDict()
+_unread_loading = {}
+_unread_lock = threading.Lock()
+
+# 获取用户未读消息数
+def get_unread_count(user_id):
+    with _unread_lock:
+        message_ids = _unread_message_ids.get(user_id)
+        if message_ids is not None:
+            _unread_message_ids.move_to_end(user_id)
+            return len(message_ids)
+        loading = _unread_loading.get(user_id)
+        if loading is None:
+            loading = _unread_loading[user_id] = {'loaders': 0, 'added': set(), 'last_read_message_id': 0}
+        loading['loaders'] += 1
+    
+    try:
+        start_cache_invalidation_listener()
+        pending_ids = get_pending_unread_ids(user_id)
+        stored_ids = [message_id for message_id, in unread_messages_query(user_id).with_entities(Message.id)]
+    except BaseException:
+        with _unread_lock:
+            finish_unread_loading(user_id, loading)
+        raise
+    
+    with _unread_lock:
+        finish_unread_loading(user_id, loading)
+        message_ids = [message_id for message_id in sorted(pending_ids.union(stored_ids, loading['added']))
+                       if message_id > loading['last_read_message_id']]
+        if loading.get('stale'):
+            return len(message_ids)
+        # 同一用户的另一个加载已经写入缓存时以缓存为准，它之后的变化都已记录在缓存中
+        if user_id in _unread_message_ids:
+            _unread_message_ids.move_to_end(user_id)
+            return len(_unread_message_ids[user_id])
+        _unread_message_ids[user_id] = message_ids
+        while len(_unread_message_ids) > app.config['UNREAD_CACHE_SIZE']:
+            _unread_message_ids.popitem(last=False)
+        return len(message_ids)
+
+# 结束一次加载，同一用户没有其他加载时去掉加载标记，调用方持有 _unread_lock
+def finish_unread_loading(user_id, loading):
+    loading['loaders'] -= 1
+    if loading['loaders'] == 0 and _unread_loading.get(user_id) is loading:
+        del _unread_loading[user_id]
+
+# 记录新保存的用户消息，用户的缓存已加载时加入列表，正在加载时记入加载标记
+def add_unread_message(user_id, message_id):
+    with _unread_lock:
+        message_ids = _unread_message_ids.get(user_id)
+        if message_ids is not None:
+            index = bisect.bisect_left(message_ids, message_id)
+            if index == len(message_ids) or message_ids[index] != message_id:
+                message_ids.insert(index, message_id)
+        loading = _unread_loading.get(user_id)
+        if loading is not None:
+            loading['added'].add(message_id)
+    publish_cache_invalidation('unread', user_id)
+
+# 管理员已读位置移动到 last_read_message_id 后，去掉不超过它的消息ID，返回剩余的未读数
+def mark_unread_messages_read(user_id, last_read_message_id):
+    with _unread_lock:
+        message_ids = _unread_message_ids.get(user_id)
+        if message_ids is not None:
+            del message_ids[:bisect.bisect_right(message_ids, last_read_message_id)]
+        loading = _unread_loading.get(user_id)
+        if loading is not None:
+            loading['last_read_message_id'] = max(loading['last_read_message_id'], last_read_message_id)
+    publish_cache_invalidation('unread', user_id)
+    return get_unread_count(user_id)
+
+# 清空本进程缓存的未读消息，不传用户时全部清空；其他进程保存用户消息或移动已读位置时也会调用
+@on_cache_invalidation('unread')
+def clear_unread_cache(user_id=None):
+    with _unread_lock:
+        if user_id is None:
+            _unread_message_ids.clear()
+            stale = list(_unread_loading.values())
+            _unread_loading.clear()
+        else:
+            _unread_message_ids.pop(user_id, None)
+            stale = [_unread_loading.pop(user_id)] if user_id in _unread_loading else []
+        # 正在进行的加载可能读到失效前的数据，结果不写入缓存
+        for loading in stale:
+            loading['stale'] = True
+
+# 使未读消息缓存失效，并通知其他进程
+def invalidate_unread_cache(user_id=None):
+    clear_unread_cache(user_id)
+    publish_cache_invalidation('unread', user_id)
+
+# 重置数据库：删除所有表后重新创建，并写入默认管理员、常见问题、自动回复、系统设置和打招呼语句
+def reset_database():
+    # 先删除所有表
+    db.drop_all()
+    invalidate_unread_cache()
+    # 重新创建所有表
+    db.create_all()
+    # 添加默认管理员
+    admin = Admin(username='admin', password=generate_password_hash('admin123'))
+    db.session.add(admin)
+    # 添加默认常见问题
+    questions = [
+        {'question': '如何注册账号？', 'content': '您可以点击首页的注册按钮，填写相关信息即可注册。', 'message_type': 'text', 'order_index': 0},
+        {'question': '如何找回密码？', 'content': '您可以点击登录页面的忘记密码，按照提示操作即可找回。', 'message_type': 'text', 'order_index': 1},
+        {'question': '客服工作时间？', 'content': '我们的客服工作时间是周一至周日 9:00-21:00。', 'message_type': 'text', 'order_index': 2}
+    ]
+    for q in questions:
+        cq = CommonQuestion(question=q['question'], content=q['content'], message_type=q['message_type'], order_index=q['order_index'])
+        db.session.add(cq)
+    # 添加默认关键词自动回复
+    auto_replies = [
+        {'keyword': '你好', 'content': '你好！请问有什么可以帮助您的？', 'message_type': 'text', 'order_index': 0},
+        {'keyword': '谢谢', 'content': '不客气，很高兴为您服务！', 'message_type': 'text', 'order_index': 1},
+        {'keyword': '再见', 'content': '再见，祝您生活愉快！', 'message_type': 'text', 'order_index': 2}
+    ]
+    for ar in auto_replies:
+        ar_obj = AutoReply(keyword=ar['keyword'], content=ar['content'], message_type=ar['message_type'], order_index=ar['order_index'])
+        db.session.add(ar_obj)
+    # 添加默认系统设置
+    settings = [
+        {'key': 'allow_user_images', 'value': 'true'},
+        {'key': 'allow_user_videos', 'value': 'true'},
+        {'key': 'chat_path', 'value': '/'},
+        {'key': 'enable_user_agent_filter', 'value': 'false'},
+        {'key': 'blocked_user_agents', 'value': 'bot,crawler,spider,scraper,python-requests,curl,wget'}
+    ]
+    for setting in settings:
+        ss = SystemSetting(key=setting['key'], value=setting['value'])
+        db.session.add(ss)
+    
+    # 添加默认打招呼语句
+    welcome_messages = [
+        {'content': '您好！欢迎使用我们的客服系统，请问有什么可以帮助您的？', 'message_type': 'text', 'order_index': 0},
+        {'content': '我们的工作时间是周一至周日 9:00-21:00', 'message_type': 'text', 'order_index': 1}
+    ]
+    for msg in welcome_messages:
+        wm = WelcomeMessage(content=msg['content'], message_type=msg['message_type'], order_index=msg['order_index'])
+        db.session.add(wm)
+    
+    db.session.commit()
+
+# 应用是否由 Flask 命令行的命令加载（flask run 除外）。gc-uploads、dedup-uploads 等维护命令也会导入本模块，
+# 此时重置数据库会清空要处理的数据，只有服务器入口（python app.py、server.py、flask run、WSGI 服务器）才重置
+def is_cli_command():
+    ctx = click.get_current_context(silent=True)
+    return ctx is not None and ctx.info_name != 'run'
+
+# 初始化数据库
+with app.app_context():
+    # 关闭 SQLITE_TUNING 时恢复默认的回滚日志模式。日志模式保存在数据库文件中，其他进程还在使用数据库时无法切换
+    if not app.config['SQLITE_TUNING'] and db.engine.dialect.name == 'sqlite':
+        try:
+            db.session.execute(db.text('PRAGMA journal_mode = DELETE'))
+            db.session.commit()
+        except OperationalError as e:
+            db.session.rollback()
+            print(f'Cannot switch SQLite journal mode back to DELETE: {e}')
+    
+    # 检查是否需要重置数据库，Flask 命令行的维护命令不重置
+    if app.config['RESET_DATABASE_ON_RESTART'] and not is_cli_command():
+        reset_database()
     else:
         # 只创建表，不删除已有数据
         db.create_all()
+        # 已有数据库补建新增的索引
+        migrate_database()
     
     # 创建分片上传临时目录
     if not os.path.exists(app.config['CHUNK_UPLOAD_FOLDER']):
         os.makedirs(app.config['CHUNK_UPLOAD_FOLDER'])
+    
+    # 创建缩略图缓存目录
+    if not os.path.exists(app.config['IMAGE_VARIANT_FOLDER']):
+        os.makedirs(app.config['IMAGE_VARIANT_FOLDER'])
+    
+    # 创建消息归档目录
+    if not os.path.exists(app.config['MESSAGE_ARCHIVE_FOLDER']):
+        os.makedirs(app.config['MESSAGE_ARCHIVE_FOLDER'])
+
+# 发送上传的文件：文件名不会指向不同的内容，使用长期不可变缓存，并以文件名作为强 ETag
+# 配置了 UPLOAD_SENDFILE_MODE 时只返回响应头，由前端代理发送文件内容和处理 Range 请求
+def send_upload(directory, filename, mimetype=None):
+    mode = app.config['UPLOAD_SENDFILE_MODE']
+    if not mode:
+        response = send_from_directory(directory, filename, mimetype=mimetype, etag=filename,
+                                       max_age=app.config['UPLOAD_CACHE_MAX_AGE'])
+        # 声明支持 Range 请求，视频播放器据此直接拖动进度
+        response.accept_ranges = 'bytes'
+    else:
+        path = safe_join(directory, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = make_response('')
+        response.mimetype = mimetype or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if mode == 'x-accel-redirect':
+            response.headers['X-Accel-Redirect'] = app.config['UPLOAD_ACCEL_REDIRECT_PREFIX'] + directory.strip('/') + '/' + filename
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+        response.set_etag(filename)
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['UPLOAD_CACHE_MAX_AGE']
+        response.make_conditional(request)
+    response.cache_control.immutable = True
+    return response
 
 # 路由
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # 带 w 参数时返回缩略图，无法生成时返回原图
+    width = request.args.get('w', type=int)
+    if request.args.get('poster') and is_video_file(filename):
+        return send_upload(app.config['IMAGE_VARIANT_FOLDER'], os.path.basename(get_video_poster_path(filename)), mimetype='image/jpeg')
+    if width and is_image_variant_source(filename):
+        variant_path = get_image_variant(filename, width)
+        if variant_path:
+            return send_upload(app.config['IMAGE_VARIANT_FOLDER'], os.path.basename(variant_path), mimetype='image/webp')
+    
+    return send_upload(app.config['UPLOAD_FOLDER'], filename)
+
+# 用户首次访问时创建用户记录并发送打招呼语句，用户和消息在同一个事务中插入
+def bootstrap_chat_user(user_id, user_agent):
+    if db.session.query(User.id).filter_by(user_id=user_id).first() is not None:
+        return
+    
+    _, welcome_messages = get_page_content()
+    db.session.add(User(
+        user_id=user_id,
+        ip_address=request.remote_addr,
+        user_agent=user_agent[:User.user_agent.type.length]  # SQLite 不检查长度，其他数据库超长时会报错
+    ))
+    # 异步写入时消息由后台线程插入，用户记录需要先提交；并发的首次访问已创建用户时由它发送打招呼语句
+    if app.config['MESSAGE_WRITE_BEHIND']:
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if db.session.query(User.id).filter_by(user_id=user_id).first() is not None:
+                return
+            raise
+    for msg in welcome_messages:
+        save_message(user_id, msg['content'], is_admin=True, message_type=msg['message_type'], commit=False)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 同一会话的并发首次访问已经创建了用户
+        db.session.rollback()
 
-@app.route('/')
-def index():
-    # 获取聊天路径设置
-    chat_path = get_system_setting('chat_path', '/')
-    # 如果设置了自定义路径，根路径返回404
-    if chat_path != '/':
-        return 'Not Found', 404
-    
+# 渲染聊天页面，根路径和自定义路径共用
+def render_chat_page():
     # 验证 User Agent
     user_agent = request.headers.get('User-Agent', '')
     if not is_valid_user_agent(user_agent):
@@ -265,40 +1016,28 @@ def index():
     user_id = session['user_id']
     
     # 记录用户信息
-    user = User.query.filter_by(user_id=user_id).first()
-    if not user:
-        user = User(
-            user_id=user_id,
-            ip_address=request.remote_addr,
-            user_agent=user_agent
-        )
-        db.session.add(user)
-        db.session.commit()
-        
-        # 用户首次访问，发送打招呼语句
-        welcome_messages = WelcomeMessage.query.order_by(WelcomeMessage.order_index).all()
-        for msg in welcome_messages:
-            welcome_message = Message(
-                user_id=user_id,
-                content=msg.content,
-                is_admin=True,
-                message_type=msg.message_type
-            )
-            db.session.add(welcome_message)
-        db.session.commit()
+    bootstrap_chat_user(user_id, user_agent)
     
     # 获取常见问题
-    common_questions = CommonQuestion.query.all()
-    # 转换为字典列表
-    common_questions_list = [{'id': cq.id, 'question': cq.question, 'answer': cq.content} for cq in common_questions]
+    common_questions, _ = get_page_content()
     
     # 获取系统设置
     allow_images = get_system_setting('allow_user_images') == 'true'
     allow_videos = get_system_setting('allow_user_videos') == 'true'
     
-    return render_template('index.html', user_id=user_id, common_questions=common_questions_list, 
+    return render_template('index.html', user_id=user_id, common_questions=common_questions, 
                            allow_images=allow_images, allow_videos=allow_videos)
 
+@app.route('/')
+def index():
+    # 获取聊天路径设置
+    chat_path = get_system_setting('chat_path', '/')
+    # 如果设置了自定义路径，根路径返回404
+    if chat_path != '/':
+        return 'Not Found', 404
+    
+    return render_chat_page()
+
 @app.route('/<path:path>')
 def custom_path(path):
     # 获取聊天路径设置
@@ -307,60 +1046,51 @@ def custom_path(path):
     if chat_path == '/' or '/' + path != chat_path:
         return 'Not Found', 404
     
-    # 生成或获取用户ID
-    if 'user_id' not in session:
-        session['user_id'] = generate_user_id()
-    user_id = session['user_id']
-    
-    # 记录用户信息
-    user = User.query.filter_by(user_id=user_id).first()
-    if not user:
-        user = User(
-            user_id=user_id,
-            ip_address=request.remote_addr,
-            user_agent=request.headers.get('User-Agent')
-        )
-        db.session.add(user)
-        db.session.commit()
-        
-        # 用户首次访问，发送打招呼语句
-        welcome_messages = WelcomeMessage.query.order_by(WelcomeMessage.order_index).all()
-        for msg in welcome_messages:
-            welcome_message = Message(
-                user_id=user_id,
-                content=msg.content,
-                is_admin=True,
-                message_type=msg.message_type
-            )
-            db.session.add(welcome_message)
-        db.session.commit()
-    
-    # 获取常见问题
-    common_questions = CommonQuestion.query.all()
-    # 转换为字典列表
-    common_questions_list = [{'id': cq.id, 'question': cq.question, 'answer': cq.content} for cq in common_questions]
-    
-    # 获取系统设置
-    allow_images = get_system_setting('allow_user_images') == 'true'
-    allow_videos = get_system_setting('allow_user_videos') == 'true'
-    
-    return render_template('index.html', user_id=user_id, common_questions=common_questions_list, 
-                           allow_images=allow_images, allow_videos=allow_videos)
+    return render_chat_page()
+
+# 按游标分页查询用户消息：since_id 获取更新的消息，before_id 获取更早的消息，都不传时获取最新一页。
+# 归档的消息都早于用户在消息表中的消息，消息表中不足一页时再从归档文件读取
+def query_message_page(user_id, since_id=None, before_id=None, limit=None):
+    limit = max(1, min(limit or app.config['MESSAGE_PAGE_SIZE'], app.config['MESSAGE_PAGE_SIZE_MAX']))
+    query = Message.query.filter_by(user_id=user_id)
+    if since_id:
+        messages = query_archived_messages(user_id, limit, since_id=since_id)
+        if len(messages) < limit:
+            messages += query.filter(Message.id > since_id).order_by(Message.id).limit(limit - len(messages)).all()
+        return messages
+    if before_id:
+        query = query.filter(Message.id < before_id)
+    messages = query.order_by(Message.id.desc()).limit(limit).all()
+    messages.reverse()
+    if len(messages) < limit:
+        messages = query_archived_messages(user_id, limit - len(messages),
+                                           before_id=messages[0].id if messages else before_id) + messages
+    return messages
 
 @app.route('/get_messages', methods=['POST'])
 @csrf.exempt
 def get_messages():
-    user_id = request.json.get('user_id')
-    messages = Message.query.filter_by(user_id=user_id).order_by(Message.created_at).all()
+    data = request.json
+    # 游标和条数必须是整数
+    try:
+        since_id, before_id, limit = [None if data.get(key) is None else int(data.get(key))
+                                      for key in ('since_id', 'before_id', 'limit')]
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Invalid paging parameters'}), 400
+    
+    flush_message_queue()
+    messages = query_message_page(data.get('user_id'), since_id, before_id, limit)
+    media_info = get_media_info(msg.content for msg in messages if msg.message_type == 'video')
     return jsonify([{
+        'id': msg.id,
         'content': msg.content,
         'is_admin': msg.is_admin,
         'message_type': msg.message_type,
+        'media': media_info.get(msg.content) if msg.message_type == 'video' else None,
         'created_at': msg.created_at.strftime('%Y-%m-%d %H:%M:%S')
     } for msg in messages])
 
 
-
 @app.route('/admin')
 def admin_login():
     if 'admin_logged_in' in session and session['admin_logged_in']:
@@ -388,32 +1118,45 @@ def admin_logout():
     session.pop('admin_logged_in', None)
     return redirect(url_for('admin_login'))
 
-@app.route('/admin/dashboard')
-def admin_dashboard():
-    if 'admin_logged_in' not in session or not session['admin_logged_in']:
-        return redirect(url_for('admin_login'))
+# 汇总仪表板用户数据：一次分组查询得到所有用户的未读数和最新消息时间
+def get_dashboard_user_data():
+    flush_message_queue()
+    
+    message_stats = db.session.query(
+        Message.user_id.label('user_id'),
+        db.func.sum(db.case((db.and_(Message.is_admin == False, Message.id > User.last_read_message_id), 1), else_=0)).label('unread_count'),
+        db.func.max(Message.created_at).label('latest_message_time')
+    ).join(User, User.user_id == Message.user_id).group_by(Message.user_id).subquery()
+    
+    # 对话已归档的用户按归档中最新消息的时间排序
+    archive_stats = db.session.query(
+        MessageArchive.user_id.label('user_id'),
+        db.func.max(MessageArchive.last_message_at).label('archived_message_time')
+    ).group_by(MessageArchive.user_id).subquery()
     
-    # 获取所有用户
-    users = User.query.all()
+    rows = db.session.query(User, message_stats.c.unread_count, message_stats.c.latest_message_time, archive_stats.c.archived_message_time) \
+        .outerjoin(message_stats, User.user_id == message_stats.c.user_id) \
+        .outerjoin(archive_stats, User.user_id == archive_stats.c.user_id).all()
     
-    # 为每个用户计算未读消息数量、设备类型和最新消息时间
     user_data = []
-    for user in users:
-        unread_count = Message.query.filter_by(user_id=user.user_id, is_admin=False, is_read=False).count()
-        device_type = detect_device_type(user.user_agent)
-        # 获取最新消息时间
-        latest_message = Message.query.filter_by(user_id=user.user_id).order_by(Message.created_at.desc()).first()
-        latest_message_time = latest_message.created_at if latest_message else user.created_at
-        
+    for user, unread_count, latest_message_time, archived_message_time in rows:
         user_data.append({
             'user': user,
-            'unread_count': unread_count,
-            'device_type': device_type,
-            'latest_message_time': latest_message_time
+            'unread_count': int(unread_count or 0),
+            'device_type': detect_device_type(user.user_agent),
+            'latest_message_time': latest_message_time or archived_message_time or user.created_at
         })
     
     # 按最新消息时间排序，最新的在上面
     user_data.sort(key=lambda x: x['latest_message_time'], reverse=True)
+    return user_data
+
+@app.route('/admin/dashboard')
+def admin_dashboard():
+    if 'admin_logged_in' not in session or not session['admin_logged_in']:
+        return redirect(url_for('admin_login'))
+    
+    user_data = get_dashboard_user_data()
     
     return render_template('admin_dashboard.html', user_data=user_data)
 
@@ -422,53 +1165,188 @@ def admin_dashboard_data():
     if 'admin_logged_in' not in session or not session['admin_logged_in']:
         return jsonify([])
     
-    # 获取所有用户
-    users = User.query.all()
     user_data = []
-    
-    for user in users:
-        # 计算未读消息数
-        unread_count = Message.query.filter_by(user_id=user.user_id, is_admin=False, is_read=False).count()
-        # 检测设备类型
-        device_type = detect_device_type(user.user_agent)
-        # 获取最新消息时间
-        latest_message = Message.query.filter_by(user_id=user.user_id).order_by(Message.created_at.desc()).first()
-        latest_message_time = latest_message.created_at if latest_message else user.created_at
-        
+    for item in get_dashboard_user_data():
+        user = item['user']
         user_data.append({
             'user': {
                 'user_id': user.user_id,
                 'alias': user.alias,
                 'ip_address': user.ip_address,
                 'user_agent': user.user_agent,
-                'device_type': device_type,
+                'device_type': item['device_type'],
                 'remark': user.remark,
                 'created_at': user.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                'latest_message_time': latest_message_time.strftime('%Y-%m-%d %H:%M:%S')
+                'latest_message_time': item['latest_message_time'].strftime('%Y-%m-%d %H:%M:%S')
             },
-            'unread_count': unread_count
+            'unread_count': item['unread_count']
         })
     
-    # 按最新消息时间排序，最新的在上面
-    user_data.sort(key=lambda x: x['user']['latest_message_time'], reverse=True)
-    
     return jsonify(user_data)
 
+# 数据库兼容性检查：在每个数据库上重建表，依次执行首次访问、收发消息（同步和异步写入）、分页、管理员用户列表、已读位置、
+# 分片上传位图、系统设置、消息归档、迁移和删除用户。会删除目标数据库中的表，只能用于临时数据库
+@app.cli.command('check-database')
+@click.option('--database', 'databases', multiple=True,
+              help='Database URL to check, repeatable. Defaults to temporary SQLite databases with and without SQLITE_TUNING.')
+@click.option('--run', is_flag=True, hidden=True)
+def check_database_command(databases, run):
+    if run:
+        reset_database()
+        run_database_checks()
+        return
+    
+    db_dir = tempfile.mkdtemp()
+    if databases:
+        matrix = [(url, {}) for url in databases]
+    else:
+        matrix = [('sqlite:///' + os.path.join(db_dir, f'{profile}.db'), {'FLASK_SQLITE_TUNING': profile})
+                  for profile in ('true', 'false')]
+    failed = 0
+    try:
+        for n, (url, extra_env) in enumerate(matrix):
+            env = dict(os.environ,
+                       FLASK_SQLALCHEMY_DATABASE_URI=url,
+                       FLASK_GC_INTERVAL='0',
+                       FLASK_MESSAGE_ARCHIVE_FOLDER=os.path.join(db_dir, f'archive-{n}'),
+                       **extra_env)
+            result = subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'check-database', '--run'],
+                                    cwd=app.root_path, env=env, capture_output=True, text=True)
+            name = make_url(url).render_as_string(hide_password=True)
+            name += ''.join(f' {key[len("FLASK_"):]}={value}' for key, value in extra_env.items())
+            if result.returncode == 0:
+                print(f'{name}: passed')
+            else:
+                failed += 1
+                print(f'{name}: failed')
+                print('\n'.join(result.stderr.strip().splitlines()[-5:]))
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+    if failed:
+        raise click.ClickException(f'{failed} of {len(matrix)} databases failed')
+
+# 获取语句的查询计划文本。检查用的表很小，PostgreSQL 关闭顺序扫描后才会按索引规划；
+# 同时关闭位图扫描和排序，否则前缀相同的两个组合索引代价相同，规划器可能任选一个再排序
+def explain_query(statement):
+    dialect = db.engine.dialect
+    sql = str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+    if dialect.name == 'sqlite':
+        rows = db.session.execute(db.text('EXPLAIN QUERY PLAN ' + sql)).all()
+    else:
+        if dialect.name == 'postgresql':
+            for setting in ('enable_seqscan', 'enable_bitmapscan', 'enable_sort'):
+                db.session.execute(db.text(f'SET LOCAL {setting} = off'))
+        rows = db.session.execute(db.text('EXPLAIN ' + sql)).all()
+    db.session.rollback()
+    return '\n'.join(' '.join(str(value) for value in row) for row in rows)
+
+# 在 check-database 的子进程中对当前配置的数据库执行检查，失败时抛出异常
+def run_database_checks():
+    def check(name, condition):
+        if not condition:
+            raise click.ClickException(f'check failed: {name}')
+    
+    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/120.0 Safari/537.36 ' + 'x' * 300}
+    client = app.test_client()
+    check('first visit', client.get('/', headers=headers).status_code == 200)
+    with client.session_transaction() as client_session:
+        user_id = client_session['user_id']
+    welcome_count = WelcomeMessage.query.count()
+    check('welcome messages', Message.query.filter_by(user_id=user_id).count() == welcome_count)
+    
+    save_chat_message(user_id, '你好')
+    check('auto reply', save_auto_reply(user_id, '你好') is not None)
+    app.config['MESSAGE_WRITE_BEHIND'] = True
+    queued_ids = [save_message(user_id, f'queued {n}').id for n in range(3)]
+    flush_message_queue()
+    app.config['MESSAGE_WRITE_BEHIND'] = False
+    message = save_message(user_id, 'after queue')
+    check('message ids', queued_ids == sorted(queued_ids) and message.id > queued_ids[-1])
+    total = welcome_count + 6
+    check('message count', Message.query.filter_by(user_id=user_id).count() == total)
+    
+    newest = query_message_page(user_id, limit=2)
+    older = query_message_page(user_id, before_id=newest[0].id, limit=100)
+    newer = query_message_page(user_id, since_id=older[-1].id)
+    check('message pages', [m.id for m in older + newest] == [m.id for m in older + newer] and len(older) == total - 2)
+    
+    check('unread count', count_unread_messages(user_id) == 5 and get_unread_count(user_id) == 5)
+    dashboard_row = next(item for item in get_dashboard_user_data() if item['user'].user_id == user_id)
+    check('dashboard', dashboard_row['unread_count'] == 5)
+    admin_client = app.test_client()
+    with admin_client.session_transaction() as admin_session:
+        admin_session['admin_logged_in'] = True
+    check('admin chat', admin_client.get(f'/admin/chat/{user_id}').status_code == 200)
+    check('mark read', count_unread_messages(user_id) == 0 and get_unread_count(user_id) == 0)
+    
+    # 分页、最新消息时间和未读数查询使用对应的组合索引
+    check('paging plan', 'ix_message_user_id_id' in explain_query(
+        Message.query.filter_by(user_id=user_id).order_by(Message.id.desc()).limit(app.config['MESSAGE_PAGE_SIZE']).statement))
+    check('latest time plan', 'ix_message_user_id_created_at' in explain_query(
+        db.select(db.func.max(Message.created_at)).where(Message.user_id == user_id)))
+    check('unread plan', 'ix_message_user_id_is_admin_id' in explain_query(unread_messages_query(user_id).statement))
+    
+    get_or_create_upload_session('check-database', 'video.mp4', 20, 'video/mp4', 10, 2)
+    for chunk_index in (3, 9, 3):
+        mark_chunk_received('check-database', chunk_index)
+    upload_session = UploadSession.query.filter_by(file_id='check-database').one()
+    check('chunk bitmap', get_received_chunk_indexes(upload_session) == [3, 9] and upload_session.received_count == 2)
+    delete_upload_session('check-database')
+    
+    blocked_user_agents = ','.join(f'agent{n}' for n in range(100))
+    update_system_setting('blocked_user_agents', blocked_user_agents)
+    check('settings', get_system_setting('blocked_user_agents') == blocked_user_agents)
+    
+    save_message(user_id, 'check-database.png', is_admin=True, message_type='image')
+    save_message(user_id, 'before archive', is_admin=True)
+    message_ids = [message.id for message in query_message_page(user_id, limit=100)]
+    db.session.execute(db.update(Message).where(Message.user_id == user_id).values(created_at=datetime.utcnow() - timedelta(days=2)))
+    db.session.commit()
+    report = Counter()
+    archive_idle_conversations(report, days=1)
+    # 消息表中 ID 最大的消息保留不归档
+    check('archive', report['archived_conversations'] == 1 and Message.query.filter_by(user_id=user_id).count() == 1)
+    message_ids.append(save_message(user_id, 'after archive', is_admin=True).id)
+    paged_ids = []
+    before_id = None
+    while True:
+        page = query_message_page(user_id, before_id=before_id, limit=3)
+        if not page:
+            break
+        paged_ids = [message.id for message in page] + paged_ids
+        before_id = page[0].id
+    check('archived pages', paged_ids == message_ids
+          and [message.id for message in query_message_page(user_id, since_id=message_ids[2], limit=100)] == message_ids[3:])
+    check('archived references', count_upload_references()['check-database.png'] == 1)
+    
+    migrate_database()
+    admin_client.get(f'/admin/delete_user/{user_id}')
+    check('delete user', User.query.filter_by(user_id=user_id).count() == 0
+          and Message.query.filter_by(user_id=user_id).count() == 0
+          and MessageArchive.query.filter_by(user_id=user_id).count() == 0)
+
 @app.route('/admin/chat/<user_id>')
 def admin_chat(user_id):
     if 'admin_logged_in' not in session or not session['admin_logged_in']:
         return redirect(url_for('admin_login'))
     
-    # 获取用户的所有消息
-    messages = Message.query.filter_by(user_id=user_id).order_by(Message.created_at).all()
+    # 获取用户最新一页消息，更早的消息由页面滚动时加载
+    flush_message_queue()
+    messages = query_message_page(user_id)
     
-    # 将用户消息标记为已读
-    for msg in messages:
-        if not msg.is_admin and not msg.is_read:
-            msg.is_read = True
-            db.session.commit()
+    # 将用户消息标记为已读：更新已读位置，并一次性更新 is_read 标记
+    if messages:
+        User.query.filter_by(user_id=user_id).update({'last_read_message_id': messages[-1].id})
+        Message.query.filter_by(user_id=user_id, is_admin=False, is_read=False).update({'is_read': True})
+        db.session.commit()
+        # 已读位置移动后推送该用户的未读数，管理员列表的未读角标随之更新
+        socketio.emit('admin_update', {
+            'user_id': user_id,
+            'unread_count': mark_unread_messages_read(user_id, messages[-1].id)
+        }, room='admin')
     
-    return render_template('admin_chat.html', user_id=user_id, messages=messages)
+    media_info = get_media_info(msg.content for msg in messages if msg.message_type == 'video')
+    return render_template('admin_chat.html', user_id=user_id, messages=messages, media_info=media_info)
 
 
 
@@ -492,7 +1370,10 @@ def add_auto_reply():
     
     auto_reply = AutoReply(keyword=keyword, content=content, message_type=message_type, order_index=order_index)
     db.session.add(auto_reply)
+    if message_type in MEDIA_MESSAGE_TYPES:
+        retain_upload(content)
     db.session.commit()
+    invalidate_auto_reply_engine()
     
     return jsonify({'status': 'success'})
 
@@ -504,7 +1385,12 @@ def delete_auto_reply(id):
     auto_reply = AutoReply.query.get(id)
     if auto_reply:
         db.session.delete(auto_reply)
+        if auto_reply.message_type in MEDIA_MESSAGE_TYPES:
+            release_upload(auto_reply.content)
         db.session.commit()
+        invalidate_auto_reply_engine()
+        if auto_reply.message_type in MEDIA_MESSAGE_TYPES:
+            delete_unused_uploads([auto_reply.content])
     
     return redirect(url_for('admin_auto_replies'))
 
@@ -528,10 +1414,680 @@ def add_common_question():
     
     cq = CommonQuestion(question=question, content=content, message_type=message_type, order_index=order_index)
     db.session.add(cq)
+    if message_type in MEDIA_MESSAGE_TYPES:
+        retain_upload(content)
     db.session.commit()
+    invalidate_auto_reply_engine()
+    invalidate_page_content_cache()
     
     return jsonify({'status': 'success'})
 
+# 内容寻址的上传存储：文件以内容哈希命名，相同内容只保存一份，引用数归零后才删除
+# 内容哈希是按固定大小分块计算的 SHA-256 摘要拼接后再取 SHA-256，乱序到达的分片也能边上传边计算
+MEDIA_MESSAGE_TYPES = ('image', 'video')
+_BLOCK_DIGEST_SIZE = hashlib.sha256().digest_size
+_upload_store_lock = threading.Lock()
+
+# 按固定大小读取数据块，只有最后一块可能不足
+def iter_blocks(stream, block_size):
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            return
+        while len(block) < block_size:
+            more = stream.read(block_size - len(block))
+            if not more:
+                break
+            block += more
+        yield block
+
+# 计算数据块摘要
+def block_digest(block):
+    return hashlib.sha256(block).digest()
+
+# 由按顺序拼接的分块摘要得到内容哈希
+def combine_block_digests(digests):
+    return hashlib.sha256(digests).hexdigest()
+
+# 读取整个文件计算内容哈希
+def hash_upload_file(path):
+    digests = bytearray()
+    with open(path, 'rb') as f:
+        for block in iter_blocks(f, app.config['UPLOAD_HASH_BLOCK_SIZE']):
+            digests += block_digest(block)
+    return combine_block_digests(bytes(digests))
+
+# 登记上传的文件，已登记时刷新最近上传时间
+def register_upload_blob(filename, content_hash, size):
+    values = {'last_stored_at': datetime.utcnow()}
+    if db.session.execute(db.update(UploadBlob).where(UploadBlob.filename == filename).values(**values)).rowcount == 0:
+        db.session.add(UploadBlob(filename=filename, content_hash=content_hash, size=size, ref_count=0, **values))
+        try:
+            db.session.commit()
+            return
+        except IntegrityError:
+            db.session.rollback()
+            db.session.execute(db.update(UploadBlob).where(UploadBlob.filename == filename).values(**values))
+    db.session.commit()
+
+# 将临时文件存入上传目录，已有相同内容时直接丢弃临时文件，返回存储的文件名
+def store_upload_file(src_path, original_filename, content_hash=None):
+    if content_hash is None:
+        content_hash = hash_upload_file(src_path)
+    filename = content_addressed_filename(content_hash, original_filename)
+    final_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    size = os.path.getsize(src_path)
+    
+    with _upload_store_lock:
+        register_upload_blob(filename, content_hash, size)
+        if os.path.exists(final_path):
+            os.remove(src_path)
+        else:
+            try:
+                os.replace(src_path, final_path)
+            except OSError:
+                # 临时目录和上传目录不在同一文件系统时复制
+                shutil.move(src_path, final_path)
+    
+    if is_image_variant_source(filename):
+        submit_image_variants(filename)
+    elif is_video_file(filename):
+        submit_video_probe(filename)
+    return filename
+
+# 保存普通上传的文件，写入临时文件的同时计算内容哈希
+def save_uploaded_file(file):
+    fd, tmp_path = tempfile.mkstemp(dir=app.config['CHUNK_UPLOAD_FOLDER'])
+    digests = bytearray()
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for block in iter_blocks(file.stream, app.config['UPLOAD_HASH_BLOCK_SIZE']):
+                out.write(block)
+                digests += block_digest(block)
+        return store_upload_file(tmp_path, file.filename, combine_block_digests(bytes(digests)))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# 增加文件引用数，随调用方的事务提交
+def retain_upload(filename, count=1):
+    db.session.execute(db.update(UploadBlob).where(UploadBlob.filename == filename).values(
+        ref_count=UploadBlob.ref_count + count
+    ))
+
+# 减少文件引用数，随调用方的事务提交
+def release_upload(filename, count=1):
+    db.session.execute(db.update(UploadBlob).where(UploadBlob.filename == filename).values(
+        ref_count=db.case((UploadBlob.ref_count > count, UploadBlob.ref_count - count), else_=0)
+    ))
+
+# 删除引用数已归零且过了保护时间的文件
+def delete_unused_uploads(filenames):
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['UPLOAD_BLOB_GRACE_PERIOD'])
+    for filename in set(filenames):
+        with _upload_store_lock:
+            result = db.session.execute(db.delete(UploadBlob).where(
+                UploadBlob.filename == filename,
+                UploadBlob.ref_count == 0,
+                UploadBlob.last_stored_at < cutoff
+            ))
+            db.session.commit()
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            if result.rowcount and os.path.exists(filepath):
+                os.remove(filepath)
+                remove_upload_derivatives(filename)
+
+# 统计各表和归档片段中对上传文件的引用数
+def count_upload_references():
+    references = Counter()
+    for model in (Message, WelcomeMessage, AutoReply, CommonQuestion):
+        rows = db.session.query(model.content, db.func.count()).filter(
+            model.message_type.in_(MEDIA_MESSAGE_TYPES)
+        ).group_by(model.content)
+        for filename, count in rows:
+            references[filename] += count
+    # 归档的消息仍然引用上传文件
+    for archived_references, in db.session.query(MessageArchive.media_references):
+        references.update(json.loads(archived_references))
+    return references
+
+# 按各表中的实际引用重建引用计数
+def rebuild_upload_refcounts():
+    db.session.execute(db.update(UploadBlob).values(ref_count=0))
+    for filename, count in count_upload_references().items():
+        retain_upload(filename, count)
+    db.session.commit()
+
+# 迁移工具：按内容对上传目录中已有的文件去重，改写引用并重建引用计数
+@app.cli.command('dedup-uploads')
+def dedup_uploads_command():
+    flush_message_queue()
+    upload_folder = app.config['UPLOAD_FOLDER']
+    renamed = {}
+    duplicate_bytes = 0
+    for name in sorted(os.listdir(upload_folder)):
+        path = os.path.join(upload_folder, name)
+        if not os.path.isfile(path) or not allowed_file(name):
+            continue
+        
+        content_hash = hash_upload_file(path)
+        filename = content_addressed_filename(content_hash, name)
+        if filename == name:
+            register_upload_blob(filename, content_hash, os.path.getsize(path))
+            continue
+        
+        canonical_path = os.path.join(upload_folder, filename)
+        if os.path.exists(canonical_path):
+            duplicate_bytes += os.path.getsize(path)
+        else:
+            try:
+                os.link(path, canonical_path)
+            except OSError:
+                shutil.copy2(path, canonical_path)
+        register_upload_blob(filename, content_hash, os.path.getsize(canonical_path))
+        renamed[name] = filename
+    
+    # 先改写引用再删除旧文件，中途失败时所有引用的文件仍然存在
+    for model in (Message, WelcomeMessage, AutoReply, CommonQuestion):
+        for old_name, filename in renamed.items():
+            model.query.filter(
+                model.content == old_name,
+                model.message_type.in_(MEDIA_MESSAGE_TYPES)
+            ).update({'content': filename}, synchronize_session=False)
+    db.session.commit()
+    invalidate_auto_reply_engine()
+    invalidate_page_content_cache()
+    
+    for old_name in renamed:
+        os.remove(os.path.join(upload_folder, old_name))
+    
+    rebuild_upload_refcounts()
+    print(f'Renamed {len(renamed)} files, reclaimed {duplicate_bytes} bytes of duplicates')
+
+# 图片缩略图：上传完成后在后台线程池中生成 WebP 缩略图，请求时缺失则即时生成，缓存在磁盘上
+# GIF 可能是动图，不生成缩略图
+IMAGE_VARIANT_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+_image_variant_executor = create_executor(app.config['IMAGE_VARIANT_WORKERS'])
+
+# 检查文件是否可以生成缩略图
+def is_image_variant_source(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in IMAGE_VARIANT_EXTENSIONS
+
+# 将请求的宽度归到配置的尺寸上，避免任意宽度都生成缓存
+def snap_image_variant_width(width):
+    widths = sorted(app.config['IMAGE_VARIANT_WIDTHS'])
+    for variant_width in widths:
+        if variant_width >= width:
+            return variant_width
+    return widths[-1]
+
+# 缩略图缓存路径
+def get_image_variant_path(filename, width):
+    return os.path.join(app.config['IMAGE_VARIANT_FOLDER'], f'{filename}.{width}.webp')
+
+# 生成缩略图，已存在时直接返回路径
+def generate_image_variant(filename, width):
+    variant_path = get_image_variant_path(filename, width)
+    if os.path.exists(variant_path):
+        return variant_path
+    
+    with Image.open(safe_join(app.config['UPLOAD_FOLDER'], filename)) as image:
+        # JPEG 解码时直接按比例缩小，减少大图的内存和计算
+        image.draft('RGB', (width, width))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((width, width))
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+        
+        # 先写临时文件再重命名，并发生成同一缩略图时不会读到不完整的文件
+        fd, tmp_path = tempfile.mkstemp(dir=app.config['IMAGE_VARIANT_FOLDER'])
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                image.save(out, 'WEBP', quality=app.config['IMAGE_VARIANT_QUALITY'])
+            os.replace(tmp_path, variant_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return variant_path
+
+# 获取请求宽度对应的缩略图，原图不存在或无法解码时返回 None
+def get_image_variant(filename, width):
+    if safe_join(app.config['UPLOAD_FOLDER'], filename) is None:
+        return None
+    try:
+        return generate_image_variant(filename, snap_image_variant_width(width))
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+# 后台生成所有尺寸的缩略图
+def _generate_image_variants(filename):
+    for width in app.config['IMAGE_VARIANT_WIDTHS']:
+        try:
+            generate_image_variant(filename, width)
+        except Exception as e:
+            print(f'Failed to generate {width}px variant of {filename}: {e}')
+            return
+
+# 提交后台缩略图任务
+def submit_image_variants(filename):
+    _image_variant_executor.submit(_generate_image_variants, filename)
+
+# 删除文件的所有缩略图和视频封面
+def remove_upload_derivatives(filename):
+    paths = [get_image_variant_path(filename, width) for width in app.config['IMAGE_VARIANT_WIDTHS']]
+    paths.append(get_video_poster_path(filename))
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+# 视频信息：上传完成后在后台用 ffprobe 读取时长和尺寸，用 ffmpeg 截取封面，结果记录在 UploadBlob 上
+# 没有安装 ffprobe 时跳过，消息中不带视频信息
+VIDEO_EXTENSIONS = {'mp4', 'mov', 'avi', 'wmv'}
+_media_probe_executor = create_executor(app.config['MEDIA_PROBE_WORKERS'])
+
+# 检查文件是否是视频
+def is_video_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in VIDEO_EXTENSIONS
+
+# 视频封面路径
+def get_video_poster_path(filename):
+    return os.path.join(app.config['IMAGE_VARIANT_FOLDER'], f'{filename}.poster.jpg')
+
+# 读取视频的宽度、高度和时长，旋转 90 度的视频交换宽高
+def probe_video(path):
+    result = subprocess.run([
+        app.config['FFPROBE_PATH'], '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'stream=width,height:stream_tags=rotate:stream_side_data=rotation:format=duration',
+        '-of', 'json', path
+    ], capture_output=True, check=True, timeout=app.config['MEDIA_PROBE_TIMEOUT'])
+    info = json.loads(result.stdout)
+    stream = info['streams'][0]
+    width, height = int(stream['width']), int(stream['height'])
+    
+    rotation = stream.get('tags', {}).get('rotate', 0)
+    for side_data in stream.get('side_data_list', []):
+        rotation = side_data.get('rotation', rotation)
+    if abs(int(float(rotation))) % 180 == 90:
+        width, height = height, width
+    
+    duration = info.get('format', {}).get('duration')
+    return width, height, float(duration) if duration else None
+
+# 截取视频封面，视频较长时取第 1 秒的画面，避开常见的黑色首帧
+def extract_video_poster(path, poster_path, duration):
+    seek = min(1.0, duration / 2) if duration else 0
+    fd, tmp_path = tempfile.mkstemp(suffix='.jpg', dir=app.config['IMAGE_VARIANT_FOLDER'])
+    os.close(fd)
+    try:
+        subprocess.run([
+            app.config['FFMPEG_PATH'], '-v', 'error', '-y', '-ss', str(seek), '-i', path,
+            '-frames:v', '1', '-vf', f"scale='min({app.config['VIDEO_POSTER_WIDTH']},iw)':-2", tmp_path
+        ], capture_output=True, check=True, timeout=app.config['MEDIA_PROBE_TIMEOUT'])
+        os.replace(tmp_path, poster_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# 后台提取视频信息，相同内容已经提取过时跳过
+def _probe_uploaded_video(filename):
+    with app.app_context():
+        try:
+            if db.session.query(UploadBlob.media_width).filter_by(filename=filename).scalar() is not None:
+                return
+            
+            path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            try:
+                width, height, duration = probe_video(path)
+                poster = None
+                if shutil.which(app.config['FFMPEG_PATH']):
+                    poster_path = get_video_poster_path(filename)
+                    extract_video_poster(path, poster_path, duration)
+                    poster = os.path.basename(poster_path)
+            except (OSError, subprocess.SubprocessError, ValueError, KeyError, IndexError) as e:
+                print(f'Failed to probe video {filename}: {e}')
+                return
+            
+            db.session.execute(db.update(UploadBlob).where(UploadBlob.filename == filename).values(
+                media_width=width,
+                media_height=height,
+                media_duration=duration,
+                media_poster=poster
+            ))
+            db.session.commit()
+        finally:
+            db.session.remove()
+
+# 提交后台视频信息提取任务，没有 ffprobe 时跳过
+def submit_video_probe(filename):
+    if shutil.which(app.config['FFPROBE_PATH']) is None:
+        return
+    _media_probe_executor.submit(_probe_uploaded_video, filename)
+
+# 批量获取视频信息，只返回已经探测完成的视频
+def get_media_info(filenames):
+    filenames = set(filenames)
+    if not filenames:
+        return {}
+    
+    blobs = UploadBlob.query.filter(UploadBlob.filename.in_(filenames), UploadBlob.media_width.isnot(None))
+    return {blob.filename: {
+        'width': blob.media_width,
+        'height': blob.media_height,
+        'duration': blob.media_duration,
+        'poster': f'/uploads/{blob.filename}?poster=1' if blob.media_poster else None
+    } for blob in blobs}
+
+# 获取消息附带的视频信息
+def get_message_media(content, message_type):
+    if message_type != 'video':
+        return None
+    return get_media_info([content]).get(content)
+
+# 分片合并：在后台线程池中进行，合并状态按 fileId 记录
+_merge_executor = create_executor(app.config['MERGE_WORKERS'])
+_merge_jobs = {}
+_merge_jobs_finished_at = {}  # 合并结束时间，结果长期无人查询时由清理任务删除
+_merge_jobs_lock = threading.Lock()
+
+# 将源文件内容追加到目标文件，优先使用内核复制，不支持时使用固定大小的缓冲区
+def copy_file_contents(src, dst):
+    kernel_copies = []
+    if hasattr(os, 'copy_file_range'):
+        kernel_copies.append(lambda count: os.copy_file_range(src.fileno(), dst.fileno(), count))
+    if hasattr(os, 'sendfile'):
+        kernel_copies.append(lambda count: os.sendfile(dst.fileno(), src.fileno(), None, count))
+    
+    remaining = os.fstat(src.fileno()).st_size - src.tell()
+    for kernel_copy in kernel_copies:
+        try:
+            while remaining > 0:
+                copied = kernel_copy(remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            return
+        except OSError:
+            # 文件系统不支持时换下一种方式，已复制部分的文件位置已经前移
+            continue
+    shutil.copyfileobj(src, dst, app.config['MERGE_BUFFER_SIZE'])
+
+# 合并分片文件
+def merge_chunk_files(chunk_dir, total_chunks, final_path):
+    with open(final_path, 'wb', buffering=0) as outfile:
+        for i in range(total_chunks):
+            chunk_path = os.path.join(chunk_dir, f'chunk_{i}')
+            with open(chunk_path, 'rb', buffering=0) as infile:
+                copy_file_contents(infile, outfile)
+
+# 后台合并任务
+def _run_merge_job(file_id, chunk_dir, total_chunks, file_name, file_size):
+    data_path = os.path.join(chunk_dir, 'data')
+    try:
+        merge_chunk_files(chunk_dir, total_chunks, data_path)
+        with app.app_context():
+            try:
+                final_filename = store_chunked_upload(chunk_dir, file_name, file_size)
+            finally:
+                db.session.remove()
+        
+        # 清理临时分片
+        shutil.rmtree(chunk_dir)
+        
+        # 确定消息类型
+        ext = file_name.rsplit('.', 1)[1].lower()
+        message_type = 'image' if ext in ['png', 'jpg', 'jpeg', 'gif'] else 'video'
+        result = {'status': 'success', 'filename': final_filename, 'message_type': message_type}
+    except Exception as e:
+        if os.path.exists(data_path):
+            os.remove(data_path)
+        result = {'status': 'error', 'message': f'Merge failed: {str(e)}'}
+    
+    with _merge_jobs_lock:
+        _merge_jobs[file_id] = result
+        _merge_jobs_finished_at[file_id] = time.time()
+
+# 提交后台合并任务
+def submit_merge_job(file_id, chunk_dir, total_chunks, file_name, file_size):
+    with _merge_jobs_lock:
+        _merge_jobs[file_id] = {'status': 'merging'}
+    _merge_executor.submit(_run_merge_job, file_id, chunk_dir, total_chunks, file_name, file_size)
+
+# 获取合并状态，合并结束后返回结果并清除记录
+def get_merge_status(file_id):
+    with _merge_jobs_lock:
+        result = _merge_jobs.get(file_id)
+        if result is None:
+            return {'status': 'not_found'}
+        if result['status'] != 'merging':
+            del _merge_jobs[file_id]
+            _merge_jobs_finished_at.pop(file_id, None)
+        return result
+
+# 分片上传：直接写入模式下所有分片写入同一个文件，文件随写入的分片增长，已收到的分片记录在 UploadSession 的位图中
+_FILE_ID_PATTERN = re.compile(r'^[\w-]+$')
+
+# 检查客户端提供的文件ID是否可以安全地作为目录名
+def is_valid_file_id(file_id):
+    return bool(file_id) and _FILE_ID_PATTERN.match(file_id) is not None
+
+# 获取分片临时目录
+def get_chunk_dir(file_id):
+    return os.path.join(app.config['CHUNK_UPLOAD_FOLDER'], file_id)
+
+# 在指定偏移位置写入全部数据
+def write_at(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+# 获取或创建上传任务，并发上传的第一个分片可能同时创建
+def get_or_create_upload_session(file_id, file_name, file_size, file_type, total_chunks, chunk_size):
+    upload_session = UploadSession.query.filter_by(file_id=file_id).first()
+    if upload_session:
+        return upload_session
+    
+    upload_session = UploadSession(
+        file_id=file_id,
+        file_name=file_name,
+        file_size=file_size,
+        file_type=file_type,
+        total_chunks=total_chunks,
+        chunk_size=chunk_size,
+        received_chunks=bytes((total_chunks + 7) // 8),
+        received_count=0
+    )
+    db.session.add(upload_session)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        upload_session = UploadSession.query.filter_by(file_id=file_id).first()
+    return upload_session
+
+# 在位图中标记分片已收到，以 received_count 作为版本号做乐观并发更新，返回已收到的分片数
+def mark_chunk_received(file_id, chunk_index):
+    byte_index, bit = divmod(chunk_index, 8)
+    while True:
+        received_chunks, received_count = db.session.query(
+            UploadSession.received_chunks, UploadSession.received_count
+        ).filter_by(file_id=file_id).one()
+        bitmap = bytearray(received_chunks)
+        if bitmap[byte_index] & (1 << bit):
+            db.session.rollback()
+            return received_count
+        
+        bitmap[byte_index] |= 1 << bit
+        result = db.session.execute(db.update(UploadSession).where(
+            UploadSession.file_id == file_id,
+            UploadSession.received_count == received_count
+        ).values(
+            received_chunks=bytes(bitmap),
+            received_count=received_count + 1,
+            updated_at=datetime.utcnow()
+        ))
+        db.session.commit()
+        if result.rowcount == 1:
+            return received_count + 1
+
+# 获取已收到的分片索引列表
+def get_received_chunk_indexes(upload_session):
+    bitmap = upload_session.received_chunks
+    return [i for i in range(upload_session.total_chunks) if bitmap[i // 8] & (1 << (i % 8))]
+
+# 删除上传任务记录
+def delete_upload_session(file_id):
+    UploadSession.query.filter_by(file_id=file_id).delete()
+    db.session.commit()
+
+# 检查客户端声明的文件大小、分片大小和分片数，不合法时抛出 ValueError
+def validate_upload_geometry(file_size, chunk_size, total_chunks):
+    if file_size <= 0 or file_size > app.config['UPLOAD_MAX_FILE_SIZE']:
+        raise ValueError('Invalid file size')
+    if chunk_size <= 0 or chunk_size > app.config['UPLOAD_MAX_CHUNK_SIZE']:
+        raise ValueError('Invalid chunk size')
+    if total_chunks != -(-file_size // chunk_size) or total_chunks > app.config['UPLOAD_MAX_CHUNKS']:
+        raise ValueError('Invalid total chunks')
+
+# 保存一个分片
+def save_upload_chunk(file, file_id, chunk_index, total_chunks, file_name, file_size, file_type, chunk_size):
+    validate_upload_geometry(file_size, chunk_size, total_chunks)
+    if chunk_index < 0 or chunk_index >= total_chunks:
+        raise ValueError('Invalid chunk index')
+    
+    upload_session = get_or_create_upload_session(file_id, file_name, file_size, file_type, total_chunks, chunk_size)
+    if (upload_session.file_size, upload_session.total_chunks, upload_session.chunk_size) != (file_size, total_chunks, chunk_size):
+        raise ValueError('Upload session mismatch')
+    
+    # 已收到的分片不再写入，避免覆盖已经记录摘要的数据
+    if upload_session.received_chunks[chunk_index // 8] & (1 << (chunk_index % 8)):
+        return upload_session.received_count
+    
+    # 分片只能写入自己的范围 [chunk_index * chunk_size, chunk_end)
+    chunk_end = min((chunk_index + 1) * chunk_size, file_size)
+    if chunk_index * chunk_size >= chunk_end:
+        raise ValueError('Invalid chunk index')
+    
+    # 创建临时分片目录
+    chunk_dir = get_chunk_dir(file_id)
+    os.makedirs(chunk_dir, exist_ok=True)
+    
+    # 分块摘要按块序号写入 hashes 文件，分片大小不是分块大小的整数倍时在完成上传时再计算
+    block_size = app.config['UPLOAD_HASH_BLOCK_SIZE']
+    open_flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    hash_fd = os.open(os.path.join(chunk_dir, 'hashes'), open_flags, 0o644) if chunk_size % block_size == 0 else None
+    
+    # 直接写入模式下分片写入目标文件的对应位置，文件只随实际写入的数据增长，不按声明的文件大小预先占用空间；
+    # 否则单独保存为分片文件
+    offset = chunk_index * chunk_size
+    if app.config['CHUNK_UPLOAD_DIRECT_WRITE']:
+        fd = os.open(os.path.join(chunk_dir, 'data'), open_flags, 0o644)
+        data_offset = offset
+    else:
+        fd = os.open(os.path.join(chunk_dir, f'chunk_{chunk_index}'), open_flags | os.O_TRUNC, 0o644)
+        data_offset = 0
+    try:
+        for block in iter_blocks(file.stream, block_size):
+            if offset + len(block) > chunk_end:
+                raise ValueError('Chunk exceeds chunk size')
+            write_at(fd, block, data_offset)
+            if hash_fd is not None:
+                write_at(hash_fd, block_digest(block), offset // block_size * _BLOCK_DIGEST_SIZE)
+            offset += len(block)
+            data_offset += len(block)
+    finally:
+        os.close(fd)
+        if hash_fd is not None:
+            os.close(hash_fd)
+    
+    # 分片长度必须正好填满自己的范围，较短的分片不标记为已收到，否则合并后的文件中留下空洞
+    if offset != chunk_end:
+        raise ValueError('Incomplete chunk')
+    
+    return mark_chunk_received(file_id, chunk_index)
+
+# 正在写入的分片数，用于限制全局和单个上传任务的并发；同一个分片同时只允许一个请求写入，
+# 避免两次上传的数据和分块摘要交错，使记录的哈希与文件内容不一致
+_inflight_chunks = {'total': 0, 'sessions': {}, 'chunks': set()}
+_inflight_chunks_lock = threading.Lock()
+
+# 占用一个分片写入名额，超出上限或同一个分片正在写入时返回 False
+def acquire_chunk_slot(file_id, chunk_index):
+    with _inflight_chunks_lock:
+        session_count = _inflight_chunks['sessions'].get(file_id, 0)
+        if (_inflight_chunks['total'] >= app.config['UPLOAD_MAX_INFLIGHT_CHUNKS']
+                or session_count >= app.config['UPLOAD_MAX_INFLIGHT_CHUNKS_PER_SESSION']
+                or (file_id, chunk_index) in _inflight_chunks['chunks']):
+            return False
+        _inflight_chunks['total'] += 1
+        _inflight_chunks['sessions'][file_id] = session_count + 1
+        _inflight_chunks['chunks'].add((file_id, chunk_index))
+        return True
+
+# 释放分片写入名额
+def release_chunk_slot(file_id, chunk_index):
+    with _inflight_chunks_lock:
+        _inflight_chunks['total'] -= 1
+        _inflight_chunks['chunks'].discard((file_id, chunk_index))
+        session_count = _inflight_chunks['sessions'][file_id] - 1
+        if session_count:
+            _inflight_chunks['sessions'][file_id] = session_count
+        else:
+            del _inflight_chunks['sessions'][file_id]
+
+# 分片写入名额已满时的响应，客户端应等待 Retry-After 秒后重试
+def chunk_upload_busy_response():
+    response = jsonify({'status': 'busy', 'message': 'Too many chunk uploads in progress'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(app.config['UPLOAD_RETRY_AFTER'])
+    return response
+
+# 统计已上传的分片数
+def count_uploaded_chunks(file_id):
+    received_count = db.session.query(UploadSession.received_count).filter_by(file_id=file_id).scalar()
+    return received_count or 0
+
+# 将组装好的分片数据存入上传存储，优先使用上传过程中记录的分块摘要。
+# 每个分片收到时已检查长度，这里再确认组装结果与声明的文件大小一致，否则文件名不是实际内容的哈希
+def store_chunked_upload(chunk_dir, file_name, file_size):
+    data_path = os.path.join(chunk_dir, 'data')
+    hashes_path = os.path.join(chunk_dir, 'hashes')
+    if os.path.getsize(data_path) != file_size:
+        raise ValueError('Upload size mismatch')
+    block_count = -(-os.path.getsize(data_path) // app.config['UPLOAD_HASH_BLOCK_SIZE'])
+    content_hash = None
+    if os.path.exists(hashes_path) and os.path.getsize(hashes_path) == block_count * _BLOCK_DIGEST_SIZE:
+        with open(hashes_path, 'rb') as f:
+            content_hash = combine_block_digests(f.read())
+    return store_upload_file(data_path, file_name, content_hash)
+
+# 完成上传：直接写入模式下将目标文件存入上传存储，否则提交后台合并任务
+def finalize_upload(file_id, chunk_dir, total_chunks, file_name):
+    upload_session = UploadSession.query.filter_by(file_id=file_id).first()
+    if upload_session is None:
+        raise ValueError('Upload session not found')
+    file_size = upload_session.file_size
+    delete_upload_session(file_id)
+    if not app.config['CHUNK_UPLOAD_DIRECT_WRITE']:
+        submit_merge_job(file_id, chunk_dir, total_chunks, file_name, file_size)
+        return {'status': 'merging', 'fileId': file_id}
+    
+    final_filename = store_chunked_upload(chunk_dir, file_name, file_size)
+    
+    # 清理临时分片
+    shutil.rmtree(chunk_dir)
+    
+    # 确定消息类型
+    ext = file_name.rsplit('.', 1)[1].lower()
+    message_type = 'image' if ext in ['png', 'jpg', 'jpeg', 'gif'] else 'video'
+    return {'status': 'success', 'filename': final_filename, 'message_type': message_type}
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     # 验证 User Agent
@@ -557,10 +2113,8 @@ def upload_file():
            (ext in ['mp4', 'mov', 'avi', 'wmv'] and not allow_videos):
             return jsonify({'status': 'error', 'message': 'File type not allowed'})
         
-        # 生成唯一文件名
-        filename = generate_unique_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        # 按内容哈希保存文件，相同内容只保存一份
+        filename = save_uploaded_file(file)
         
         # 确定消息类型
         message_type = 'image' if ext in ['png', 'jpg', 'jpeg', 'gif'] else 'video'
@@ -585,33 +2139,31 @@ def upload_chunk():
     chunk_index = int(request.form.get('chunkIndex'))
     total_chunks = int(request.form.get('totalChunks'))
     file_name = request.form.get('fileName')
+    file_size = request.form.get('fileSize', type=int)
+    chunk_size = request.form.get('chunkSize', app.config['UPLOAD_CHUNK_SIZE'], type=int)
     
-    if not file_id or not file_name:
+    if not file_id or not file_name or file_size is None:
         return jsonify({'status': 'error', 'message': 'Missing required parameters'})
     
-    # 创建临时分片目录
-    chunk_dir = os.path.join(app.config['CHUNK_UPLOAD_FOLDER'], file_id)
-    if not os.path.exists(chunk_dir):
-        os.makedirs(chunk_dir)
+    if not is_valid_file_id(file_id):
+        return jsonify({'status': 'error', 'message': 'Invalid file ID'})
     
-    # 保存分片
-    chunk_filename = f"chunk_{chunk_index}"
-    chunk_path = os.path.join(chunk_dir, chunk_filename)
-    file.save(chunk_path)
-    
-    # 保存元数据
-    metadata = {
-        'fileId': file_id,
-        'fileName': file_name,
-        'fileSize': request.form.get('fileSize'),
-        'fileType': request.form.get('fileType'),
-        'totalChunks': total_chunks,
-        'uploadedChunks': len([f for f in os.listdir(chunk_dir) if f.startswith('chunk_')])
-    }
+    # 创建上传任务前检查文件大小、分片大小和分片数是否一致
+    try:
+        validate_upload_geometry(file_size, chunk_size, total_chunks)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    
+    if not acquire_chunk_slot(file_id, chunk_index):
+        return chunk_upload_busy_response()
     
-    metadata_path = os.path.join(chunk_dir, 'metadata.json')
-    with open(metadata_path, 'w') as f:
-        json.dump(metadata, f)
+    # 保存分片
+    try:
+        save_upload_chunk(file, file_id, chunk_index, total_chunks, file_name, file_size, request.form.get('fileType'), chunk_size)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)})
+    finally:
+        release_chunk_slot(file_id, chunk_index)
     
     return jsonify({'status': 'success', 'chunkIndex': chunk_index})
 
@@ -632,10 +2184,13 @@ def merge_chunks():
     if not file_id or not total_chunks or not file_name:
         return jsonify({'status': 'error', 'message': 'Missing required parameters'})
     
-    chunk_dir = os.path.join(app.config['CHUNK_UPLOAD_FOLDER'], file_id)
+    if not is_valid_file_id(file_id):
+        return jsonify({'status': 'error', 'message': 'Invalid file ID'})
+    
+    chunk_dir = get_chunk_dir(file_id)
     
     # 检查所有分片是否都已上传
-    uploaded_chunks = len([f for f in os.listdir(chunk_dir) if f.startswith('chunk_')])
+    uploaded_chunks = count_uploaded_chunks(file_id)
     if uploaded_chunks != total_chunks:
         return jsonify({'status': 'error', 'message': f'Not all chunks uploaded ({uploaded_chunks}/{total_chunks})'})
     
@@ -652,30 +2207,26 @@ def merge_chunks():
        (ext in ['mp4', 'mov', 'avi', 'wmv'] and not allow_videos):
         return jsonify({'status': 'error', 'message': 'File type not allowed'})
     
-    # 生成最终文件名
-    final_filename = generate_unique_filename(file_name)
-    final_path = os.path.join(app.config['UPLOAD_FOLDER'], final_filename)
-    
-    # 合并分片
+    # 完成上传，分片模式下在后台线程合并，客户端通过合并状态接口获取结果
     try:
-        with open(final_path, 'wb') as outfile:
-            for i in range(total_chunks):
-                chunk_path = os.path.join(chunk_dir, f'chunk_{i}')
-                with open(chunk_path, 'rb') as infile:
-                    outfile.write(infile.read())
-        
-        # 清理临时分片
-        import shutil
-        shutil.rmtree(chunk_dir)
-        
-        # 确定消息类型
-        message_type = 'image' if ext in ['png', 'jpg', 'jpeg', 'gif'] else 'video'
-        
-        return jsonify({'status': 'success', 'filename': final_filename, 'message_type': message_type})
-    
+        return jsonify(finalize_upload(file_id, chunk_dir, total_chunks, file_name))
     except Exception as e:
         return jsonify({'status': 'error', 'message': f'Merge failed: {str(e)}'})
 
+@app.route('/merge_status', methods=['POST'])
+@csrf.exempt
+def merge_status():
+    # 验证 User Agent
+    user_agent = request.headers.get('User-Agent', '')
+    if not is_valid_user_agent(user_agent):
+        return jsonify({'status': 'error', 'message': 'Access Denied: Invalid User Agent'}), 403
+    
+    file_id = request.json.get('fileId')
+    if not file_id:
+        return jsonify({'status': 'error', 'message': 'Missing file ID'})
+    
+    return jsonify(get_merge_status(file_id))
+
 @app.route('/check_upload_status', methods=['POST'])
 @csrf.exempt
 def check_upload_status():
@@ -690,19 +2241,24 @@ def check_upload_status():
     if not file_id:
         return jsonify({'status': 'error', 'message': 'Missing file ID'})
     
-    chunk_dir = os.path.join(app.config['CHUNK_UPLOAD_FOLDER'], file_id)
+    if not is_valid_file_id(file_id):
+        return jsonify({'status': 'error', 'message': 'Invalid file ID'})
     
-    if not os.path.exists(chunk_dir):
+    upload_session = UploadSession.query.filter_by(file_id=file_id).first()
+    if not upload_session:
         return jsonify({'status': 'not_found', 'uploadedChunks': 0})
     
-    metadata_path = os.path.join(chunk_dir, 'metadata.json')
-    if os.path.exists(metadata_path):
-        with open(metadata_path, 'r') as f:
-            metadata = json.load(f)
-        return jsonify({'status': 'success', **metadata})
-    else:
-        uploaded_chunks = len([f for f in os.listdir(chunk_dir) if f.startswith('chunk_')])
-        return jsonify({'status': 'success', 'uploadedChunks': uploaded_chunks})
+    return jsonify({
+        'status': 'success',
+        'fileId': upload_session.file_id,
+        'fileName': upload_session.file_name,
+        'fileSize': upload_session.file_size,
+        'fileType': upload_session.file_type,
+        'totalChunks': upload_session.total_chunks,
+        'chunkSize': upload_session.chunk_size,
+        'uploadedChunks': upload_session.received_count,
+        'receivedChunks': get_received_chunk_indexes(upload_session)
+    })
 
 @app.route('/delete_chunks', methods=['POST'])
 @csrf.exempt
@@ -718,10 +2274,13 @@ def delete_chunks():
     if not file_id:
         return jsonify({'status': 'error', 'message': 'Missing file ID'})
     
-    chunk_dir = os.path.join(app.config['CHUNK_UPLOAD_FOLDER'], file_id)
+    if not is_valid_file_id(file_id):
+        return jsonify({'status': 'error', 'message': 'Invalid file ID'})
+    
+    chunk_dir = get_chunk_dir(file_id)
+    delete_upload_session(file_id)
     
     if os.path.exists(chunk_dir):
-        import shutil
         shutil.rmtree(chunk_dir)
         return jsonify({'status': 'success'})
     else:
@@ -740,10 +2299,8 @@ def admin_upload_file():
         return jsonify({'status': 'error', 'message': 'No selected file'})
     
     if file and allowed_file(file.filename):
-        # 生成唯一文件名
-        filename = generate_unique_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        # 按内容哈希保存文件，相同内容只保存一份
+        filename = save_uploaded_file(file)
         
         # 确定消息类型
         ext = file.filename.rsplit('.', 1)[1].lower()
@@ -767,33 +2324,31 @@ def admin_upload_chunk():
     chunk_index = int(request.form.get('chunkIndex'))
     total_chunks = int(request.form.get('totalChunks'))
     file_name = request.form.get('fileName')
+    file_size = request.form.get('fileSize', type=int)
+    chunk_size = request.form.get('chunkSize', app.config['UPLOAD_CHUNK_SIZE'], type=int)
     
-    if not file_id or not file_name:
+    if not file_id or not file_name or file_size is None:
         return jsonify({'status': 'error', 'message': 'Missing required parameters'})
     
-    # 创建临时分片目录
-    chunk_dir = os.path.join(app.config['CHUNK_UPLOAD_FOLDER'], file_id)
-    if not os.path.exists(chunk_dir):
-        os.makedirs(chunk_dir)
+    if not is_valid_file_id(file_id):
+        return jsonify({'status': 'error', 'message': 'Invalid file ID'})
     
-    # 保存分片
-    chunk_filename = f"chunk_{chunk_index}"
-    chunk_path = os.path.join(chunk_dir, chunk_filename)
-    file.save(chunk_path)
-    
-    # 保存元数据
-    metadata = {
-        'fileId': file_id,
-        'fileName': file_name,
-        'fileSize': request.form.get('fileSize'),
-        'fileType': request.form.get('fileType'),
-        'totalChunks': total_chunks,
-        'uploadedChunks': len([f for f in os.listdir(chunk_dir) if f.startswith('chunk_')])
-    }
+    # 创建上传任务前检查文件大小、分片大小和分片数是否一致
+    try:
+        validate_upload_geometry(file_size, chunk_size, total_chunks)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
     
-    metadata_path = os.path.join(chunk_dir, 'metadata.json')
-    with open(metadata_path, 'w') as f:
-        json.dump(metadata, f)
+    if not acquire_chunk_slot(file_id, chunk_index):
+        return chunk_upload_busy_response()
+    
+    # 保存分片
+    try:
+        save_upload_chunk(file, file_id, chunk_index, total_chunks, file_name, file_size, request.form.get('fileType'), chunk_size)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)})
+    finally:
+        release_chunk_slot(file_id, chunk_index)
     
     return jsonify({'status': 'success', 'chunkIndex': chunk_index})
 
@@ -812,10 +2367,13 @@ def admin_merge_chunks():
     if not file_id or not total_chunks or not file_name:
         return jsonify({'status': 'error', 'message': 'Missing required parameters'})
     
-    chunk_dir = os.path.join(app.config['CHUNK_UPLOAD_FOLDER'], file_id)
+    if not is_valid_file_id(file_id):
+        return jsonify({'status': 'error', 'message': 'Invalid file ID'})
+    
+    chunk_dir = get_chunk_dir(file_id)
     
     # 检查所有分片是否都已上传
-    uploaded_chunks = len([f for f in os.listdir(chunk_dir) if f.startswith('chunk_')])
+    uploaded_chunks = count_uploaded_chunks(file_id)
     if uploaded_chunks != total_chunks:
         return jsonify({'status': 'error', 'message': f'Not all chunks uploaded ({uploaded_chunks}/{total_chunks})'})
     
@@ -823,31 +2381,24 @@ def admin_merge_chunks():
     if not allowed_file(file_name):
         return jsonify({'status': 'error', 'message': 'File type not allowed'})
     
-    # 生成最终文件名
-    final_filename = generate_unique_filename(file_name)
-    final_path = os.path.join(app.config['UPLOAD_FOLDER'], final_filename)
-    
-    # 合并分片
+    # 完成上传，分片模式下在后台线程合并，客户端通过合并状态接口获取结果
     try:
-        with open(final_path, 'wb') as outfile:
-            for i in range(total_chunks):
-                chunk_path = os.path.join(chunk_dir, f'chunk_{i}')
-                with open(chunk_path, 'rb') as infile:
-                    outfile.write(infile.read())
-        
-        # 清理临时分片
-        import shutil
-        shutil.rmtree(chunk_dir)
-        
-        # 确定消息类型
-        ext = file_name.rsplit('.', 1)[1].lower()
-        message_type = 'image' if ext in ['png', 'jpg', 'jpeg', 'gif'] else 'video'
-        
-        return jsonify({'status': 'success', 'filename': final_filename, 'message_type': message_type})
-    
+        return jsonify(finalize_upload(file_id, chunk_dir, total_chunks, file_name))
     except Exception as e:
         return jsonify({'status': 'error', 'message': f'Merge failed: {str(e)}'})
 
+@app.route('/admin/merge_status', methods=['POST'])
+@csrf.exempt
+def admin_merge_status():
+    if 'admin_logged_in' not in session or not session['admin_logged_in']:
+        return jsonify({'status': 'error', 'message': 'Unauthorized'})
+    
+    file_id = request.json.get('fileId')
+    if not file_id:
+        return jsonify({'status': 'error', 'message': 'Missing file ID'})
+    
+    return jsonify(get_merge_status(file_id))
+
 @app.route('/admin/settings', methods=['GET', 'POST'])
 def admin_settings():
     if 'admin_logged_in' not in session or not session['admin_logged_in']:
@@ -946,6 +2497,7 @@ def admin_welcome_messages():
                     )
                     db.session.add(welcome_message)
                     db.session.commit()
+                    invalidate_page_content_cache()
             else:
                 # 处理图片和视频 - 使用分片上传的文件名
                 uploaded_filename = request.form.get('uploaded_filename')
@@ -956,7 +2508,9 @@ def admin_welcome_messages():
                         order_index=order_index
                     )
                     db.session.add(welcome_message)
+                    retain_upload(uploaded_filename)
                     db.session.commit()
+                    invalidate_page_content_cache()
     
     # 获取所有打招呼语句，按排序索引排序
     welcome_messages = WelcomeMessage.query.order_by(WelcomeMessage.order_index).all()
@@ -970,14 +2524,14 @@ def delete_welcome_message(id):
     
     welcome_message = WelcomeMessage.query.get(id)
     if welcome_message:
-        # 如果是图片或视频，删除文件
-        if welcome_message.message_type in ['image', 'video']:
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], welcome_message.content)
-            if os.path.exists(filepath):
-                os.remove(filepath)
-        
         db.session.delete(welcome_message)
+        # 如果是图片或视频，文件不再被引用时删除
+        if welcome_message.message_type in MEDIA_MESSAGE_TYPES:
+            release_upload(welcome_message.content)
         db.session.commit()
+        invalidate_page_content_cache()
+        if welcome_message.message_type in MEDIA_MESSAGE_TYPES:
+            delete_unused_uploads([welcome_message.content])
     
     return redirect('/admin/welcome_messages')
 
@@ -994,6 +2548,7 @@ def update_setting():
     if setting:
         setting.value = value
         db.session.commit()
+        invalidate_settings_cache()
         return jsonify({'status': 'success'})
     
     return jsonify({'status': 'error', 'message': 'Setting not found'})
@@ -1006,7 +2561,13 @@ def delete_common_question(id):
     cq = CommonQuestion.query.get(id)
     if cq:
         db.session.delete(cq)
+        if cq.message_type in MEDIA_MESSAGE_TYPES:
+            release_upload(cq.content)
         db.session.commit()
+        invalidate_auto_reply_engine()
+        invalidate_page_content_cache()
+        if cq.message_type in MEDIA_MESSAGE_TYPES:
+            delete_unused_uploads([cq.content])
     
     return redirect(url_for('admin_common_questions'))
 
@@ -1015,17 +2576,24 @@ def delete_user(user_id):
     if 'admin_logged_in' not in session or not session['admin_logged_in']:
         return redirect(url_for('admin_login'))
     
-    # 删除用户的所有消息
-    messages = Message.query.filter_by(user_id=user_id).all()
-    for message in messages:
-        db.session.delete(message)
-    
-    # 删除用户记录
-    user = User.query.filter_by(user_id=user_id).first()
-    if user:
-        db.session.delete(user)
-    
+    # 统计用户消息和归档片段引用的上传文件，再用一条语句删除用户的全部消息、归档片段和用户记录。
+    # 归档文件只追加，文件中的片段都删除后由后台清理删除文件
+    flush_message_queue()
+    media_references = Counter(dict(db.session.query(Message.content, db.func.count()).filter(
+        Message.user_id == user_id,
+        Message.message_type.in_(MEDIA_MESSAGE_TYPES)
+    ).group_by(Message.content)))
+    for archived_references, in db.session.query(MessageArchive.media_references).filter_by(user_id=user_id):
+        media_references.update(json.loads(archived_references))
+    for filename, count in media_references.items():
+        release_upload(filename, count)
+    
+    db.session.execute(db.delete(Message).where(Message.user_id == user_id))
+    db.session.execute(db.delete(MessageArchive).where(MessageArchive.user_id == user_id))
+    db.session.execute(db.delete(User).where(User.user_id == user_id))
     db.session.commit()
+    invalidate_unread_cache(user_id)
+    delete_unused_uploads(media_references)
     
     return redirect(url_for('admin_dashboard'))
 
@@ -1049,47 +2617,632 @@ def update_user_info():
     else:
         return jsonify({'status': 'error', 'message': 'User not found'})
 
+# 查看缓存命中统计
+@app.route('/admin/cache_stats')
+def cache_stats():
+    if 'admin_logged_in' not in session or not session['admin_logged_in']:
+        return jsonify({'status': 'error', 'message': 'Unauthorized'})
+    
+    lookups = settings_cache_stats['hits'] + settings_cache_stats['misses']
+    return jsonify({
+        'settings': {
+            **settings_cache_stats,
+            'hit_rate': settings_cache_stats['hits'] / lookups if lookups else 0
+        },
+        'device_type': lru_cache_stats(detect_device_type),
+        'blocked_user_agent': lru_cache_stats(is_blocked_user_agent),
+        'auto_reply': auto_reply_engine_stats,
+        'page_content': page_content_cache_stats,
+        'archive_segment': lru_cache_stats(read_archive_segment)
+    })
+
+# 汇总 lru_cache 的命中统计
+def lru_cache_stats(func):
+    info = func.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'size': info.currsize,
+        'max_size': info.maxsize,
+        'hit_rate': info.hits / lookups if lookups else 0
+    }
+
 # 生成验证码
-@app.route('/admin/captcha')
-def generate_captcha():
+# 验证码：字体只加载一次，后台线程预先渲染验证码放入有界的池中，请求时直接取出
+def load_captcha_font():
+    # 尝试使用系统字体，如果失败则使用默认字体
+    try:
+        return ImageFont.truetype('arial.ttf', 28)
+    except OSError:
+        return ImageFont.load_default()
+
+_captcha_font = load_captcha_font()
+_captcha_pool = queue.Queue(maxsize=app.config['CAPTCHA_POOL_SIZE'])
+_captcha_refiller = {'thread': None}
+_captcha_refiller_lock = threading.Lock()
+
+# 渲染一张验证码，返回验证码文本和 PNG 数据
+def render_captcha():
     # 生成随机验证码
     captcha_text = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
     
-    # 存储验证码到session
-    session['captcha'] = captcha_text
-    
     # 创建验证码图像
     width, height = 120, 40
     image = Image.new('RGB', (width, height), color=(255, 255, 255))
     draw = ImageDraw.Draw(image)
     
-    # 尝试使用系统字体，如果失败则使用默认字体
-    try:
-        font = ImageFont.truetype('arial.ttf', 28)
-    except:
-        font = ImageFont.load_default()
-    
     # 绘制验证码文本
     for i, char in enumerate(captcha_text):
-        draw.text((20 + i * 25, 5), char, fill=(random.randint(0, 100), random.randint(0, 100), random.randint(0, 100)), font=font)
+        draw.text((20 + i * 25, 5), char, fill=(random.randint(0, 100), random.randint(0, 100), random.randint(0, 100)), font=_captcha_font)
     
     # 添加干扰线
     for _ in range(5):
         draw.line([(random.randint(0, width), random.randint(0, height)), (random.randint(0, width), random.randint(0, height))], fill=(random.randint(0, 200), random.randint(0, 200), random.randint(0, 200)), width=1)
     
-    # 添加干扰点
-    for _ in range(50):
-        draw.point([(random.randint(0, width), random.randint(0, height))], fill=(random.randint(0, 200), random.randint(0, 200), random.randint(0, 200)))
+    # 添加干扰点：分成 5 组，每组一种颜色一次画完
+    for _ in range(5):
+        points = list(zip(random.choices(range(width + 1), k=10), random.choices(range(height + 1), k=10)))
+        draw.point(points, fill=(random.randint(0, 200), random.randint(0, 200), random.randint(0, 200)))
     
-    # 将图像转换为响应
+    # 验证码图片很小，使用最快的压缩级别
     buffer = io.BytesIO()
-    image.save(buffer, format='PNG')
-    buffer.seek(0)
+    image.save(buffer, format='PNG', compress_level=1)
+    return captcha_text, buffer.getvalue()
+
+# 后台补充线程：池满时阻塞，取出一张后立即补上
+def _captcha_refiller_loop():
+    while True:
+        _captcha_pool.put(render_captcha())
+
+# 启动后台补充线程
+def start_captcha_refiller():
+    if _captcha_refiller['thread'] is not None:
+        return
+    with _captcha_refiller_lock:
+        if _captcha_refiller['thread'] is None:
+            _captcha_refiller['thread'] = threading.Thread(target=_captcha_refiller_loop, daemon=True)
+            _captcha_refiller['thread'].start()
+
+# 取出一张验证码，池为空时当场渲染
+def take_captcha():
+    start_captcha_refiller()
+    try:
+        return _captcha_pool.get_nowait()
+    except queue.Empty:
+        return render_captcha()
+
+@app.route('/admin/captcha')
+def generate_captcha():
+    captcha_text, png = take_captcha()
+    
+    # 存储验证码到session
+    session['captcha'] = captcha_text
     
-    response = make_response(buffer.getvalue())
+    response = make_response(png)
     response.headers['Content-Type'] = 'image/png'
+    response.headers['Cache-Control'] = 'no-store'
     return response
 
+# 消息异步批量写入：消息先分配ID并立即推送，由后台线程分批提交到数据库
+_message_queue = queue.Queue()
+_message_writer = {'thread': None, 'next_id': None, 'enqueued': 0, 'written': 0}
+_message_writer_lock = threading.Lock()
+_message_written = threading.Condition(_message_writer_lock)
+_pending_unread = {}
+
+# 保存消息，开启异步写入时只分配ID并放入写入队列
+def save_message(user_id, content, is_admin=False, message_type='text', commit=True):
+    message = Message(
+        user_id=user_id,
+        content=content,
+        is_admin=is_admin,
+        is_read=False,
+        message_type=message_type
+    )
+    if not app.config['MESSAGE_WRITE_BEHIND']:
+        db.session.add(message)
+        if message_type in MEDIA_MESSAGE_TYPES:
+            retain_upload(content)
+        if commit:
+            db.session.commit()
+            if not is_admin:
+                add_unread_message(user_id, message.id)
+        return message
+    
+    # 使用序列生成主键的数据库（PostgreSQL 等）从序列取 ID，显式写入的 ID 不会推进序列；
+    # SQLite 和 MySQL 的自增主键在显式写入后从最大值继续，在本进程内从最大 ID 之后连续分配
+    if db.engine.dialect.supports_sequences:
+        message.id = db.session.scalar(db.select(message_id_seq.next_value()))
+    with _message_writer_lock:
+        if message.id is None:
+            if _message_writer['next_id'] is None:
+                _message_writer['next_id'] = (db.session.query(db.func.max(Message.id)).scalar() or 0) + 1
+            message.id = _message_writer['next_id']
+            _message_writer['next_id'] += 1
+        message.created_at = datetime.utcnow()
+        if not is_admin:
+            _pending_unread.setdefault(user_id, set()).add(message.id)
+        if _message_writer['thread'] is None:
+            _message_writer['thread'] = threading.Thread(target=_message_writer_loop, daemon=True)
+            _message_writer['thread'].start()
+        
+        # 在锁内入队，队列顺序与入队序号一致，写入线程按顺序处理，已写入数即为已完成的最大序号
+        _message_writer['enqueued'] += 1
+        _message_queue.put({
+            'id': message.id,
+            'user_id': message.user_id,
+            'content': message.content,
+            'is_admin': message.is_admin,
+            'is_read': message.is_read,
+            'message_type': message.message_type,
+            'created_at': message.created_at
+        })
+    if not is_admin:
+        add_unread_message(user_id, message.id)
+    return message
+
+# 获取用户发送的、还未写入数据库的消息ID
+def get_pending_unread_ids(user_id):
+    with _message_writer_lock:
+        return set(_pending_unread.get(user_id, ()))
+
+# 后台写入线程：攒够一批或等待超时后一次提交
+def _message_writer_loop():
+    batch_size = app.config['MESSAGE_WRITE_BEHIND_BATCH_SIZE']
+    max_delay = app.config['MESSAGE_WRITE_BEHIND_MAX_DELAY']
+    running = True
+    while running:
+        row = _message_queue.get()
+        if row is None:
+            break
+        
+        batch = [row]
+        deadline = time.time() + max_delay
+        while len(batch) < batch_size:
+            try:
+                row = _message_queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if row is None:
+                running = False
+                break
+            batch.append(row)
+        
+        _write_message_batch(batch)
+
+# 在一个事务中写入若干条消息并增加媒体文件引用
+def _insert_message_rows(rows):
+    db.session.execute(Message.__table__.insert(), rows)
+    media_references = Counter(row['content'] for row in rows if row['message_type'] in MEDIA_MESSAGE_TYPES)
+    for filename, count in media_references.items():
+        retain_upload(filename, count)
+    db.session.commit()
+
+# 将一批消息写入数据库，批量写入多次失败后逐条写入，只有单条也写不进去的消息记录到日志
+def _write_message_batch(batch):
+    with app.app_context():
+        try:
+            retries = app.config['MESSAGE_WRITE_BEHIND_RETRIES']
+            for attempt in range(retries + 1):
+                try:
+                    _insert_message_rows(batch)
+                    break
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.warning('Failed to write %d messages (attempt %d): %s', len(batch), attempt + 1, e)
+                    if attempt < retries:
+                        time.sleep(0.1 * (attempt + 1))
+            else:
+                for row in batch:
+                    try:
+                        _insert_message_rows([row])
+                    except Exception:
+                        db.session.rollback()
+                        app.logger.exception('Failed to write message: %r', row)
+        finally:
+            db.session.remove()
+    
+    with _message_written:
+        for row in batch:
+            if not row['is_admin']:
+                _pending_unread[row['user_id']].discard(row['id'])
+                if not _pending_unread[row['user_id']]:
+                    del _pending_unread[row['user_id']]
+        _message_writer['written'] += len(batch)
+        _message_written.notify_all()
+
+# 等待调用时已入队的消息全部写入数据库，之后入队的消息不需要等待
+def flush_message_queue():
+    with _message_written:
+        target = _message_writer['enqueued']
+        while _message_writer['written'] < target:
+            _message_written.wait()
+
+# 程序退出时写完队列中剩余的消息
+@atexit.register
+def stop_message_writer():
+    thread = _message_writer['thread']
+    if thread is not None and thread.is_alive():
+        _message_queue.put(None)
+        thread.join()
+        _message_writer['thread'] = None
+
+# 垃圾回收：后台定期清理过期的分片上传任务、无引用的上传文件和孤立的缩略图，删除速度受 GC_DELETE_RATE 限制
+_garbage_collector = {'thread': None, 'last_report': None, 'totals': Counter()}
+_garbage_collector_lock = threading.Lock()
+
+# 每次删除后暂停，限制删除速度
+def _gc_pause():
+    time.sleep(1 / app.config['GC_DELETE_RATE'])
+
+# 获取文件或目录占用的字节数和最后修改时间
+def get_path_usage(path):
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+    size, mtime = 0, os.stat(path).st_mtime
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime)
+    return size, mtime
+
+# 删除文件或目录，返回回收的字节数
+def remove_path(path):
+    try:
+        size, _ = get_path_usage(path)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return size
+
+# 清理超过 UPLOAD_SESSION_TTL 未收到分片的上传任务，以及没有上传任务记录的过期分片目录和临时文件
+def sweep_upload_sessions(report):
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['UPLOAD_SESSION_TTL'])
+    expired = [file_id for (file_id,) in db.session.query(UploadSession.file_id).filter(UploadSession.updated_at < cutoff)]
+    for file_id in expired:
+        delete_upload_session(file_id)
+        report['upload_sessions'] += 1
+        chunk_dir = get_chunk_dir(file_id)
+        if os.path.exists(chunk_dir):
+            report['chunk_bytes'] += remove_path(chunk_dir)
+            _gc_pause()
+    
+    active = {file_id for (file_id,) in db.session.query(UploadSession.file_id)}
+    with _merge_jobs_lock:
+        active.update(file_id for file_id, result in _merge_jobs.items() if result['status'] == 'merging')
+    cutoff_time = time.time() - app.config['UPLOAD_SESSION_TTL']
+    for entry in os.scandir(app.config['CHUNK_UPLOAD_FOLDER']):
+        if entry.name.startswith('.') or entry.name in active:
+            continue
+        try:
+            size, mtime = get_path_usage(entry.path)
+        except FileNotFoundError:
+            continue
+        if mtime < cutoff_time:
+            report['chunk_bytes'] += remove_path(entry.path)
+            report['chunk_entries'] += 1
+            _gc_pause()
+
+# 清理长期无人查询的合并结果
+def sweep_merge_jobs(report):
+    cutoff_time = time.time() - app.config['UPLOAD_SESSION_TTL']
+    with _merge_jobs_lock:
+        expired = [file_id for file_id, finished_at in _merge_jobs_finished_at.items() if finished_at < cutoff_time]
+        for file_id in expired:
+            _merge_jobs.pop(file_id, None)
+            del _merge_jobs_finished_at[file_id]
+    report['merge_jobs'] += len(expired)
+
+# 标记-清除：删除各表都不再引用、引用数为零且过了保护时间的上传文件
+def sweep_unreferenced_uploads(report):
+    flush_message_queue()
+    referenced = set(count_upload_references())
+    blobs = {blob.filename: blob for blob in db.session.query(
+        UploadBlob.filename, UploadBlob.ref_count, UploadBlob.last_stored_at
+    )}
+    grace_period = app.config['UPLOAD_BLOB_GRACE_PERIOD']
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_period)
+    cutoff_time = time.time() - grace_period
+    
+    for entry in os.scandir(app.config['UPLOAD_FOLDER']):
+        if not entry.is_file() or not allowed_file(entry.name) or entry.name in referenced:
+            continue
+        blob = blobs.get(entry.name)
+        if entry.stat().st_mtime >= cutoff_time or (blob and (blob.ref_count or blob.last_stored_at >= cutoff)):
+            continue
+        
+        with _upload_store_lock:
+            # 标记之后又被引用或重新上传的文件不删除
+            if blob:
+                result = db.session.execute(db.delete(UploadBlob).where(
+                    UploadBlob.filename == entry.name,
+                    UploadBlob.ref_count == 0,
+                    UploadBlob.last_stored_at < cutoff
+                ))
+                db.session.commit()
+                if not result.rowcount:
+                    continue
+            report['upload_bytes'] += remove_path(entry.path)
+            remove_upload_derivatives(entry.name)
+        report['uploads'] += 1
+        _gc_pause()
+
+# 清理原文件已不存在的缩略图、视频封面和生成失败留下的临时文件
+def sweep_orphaned_variants(report):
+    cutoff_time = time.time() - app.config['UPLOAD_BLOB_GRACE_PERIOD']
+    for entry in os.scandir(app.config['IMAGE_VARIANT_FOLDER']):
+        if entry.name.startswith('.') or not entry.is_file():
+            continue
+        source = os.path.join(app.config['UPLOAD_FOLDER'], entry.name.rsplit('.', 2)[0])
+        if os.path.exists(source) or entry.stat().st_mtime >= cutoff_time:
+            continue
+        report['variant_bytes'] += remove_path(entry.path)
+        report['variants'] += 1
+        _gc_pause()
+
+# 消息归档：长期没有新消息的对话移出消息表，写入每天一个的归档文件，消息表只保留活跃对话，索引更容易留在缓存中。
+# 每个对话片段是一个独立的 gzip 成员，读取时只解压需要的片段；整个文件也可以直接用 zcat 查看。
+# 多个进程都运行后台清理时同一时间只有一个进程归档
+_message_archive_lock = threading.Lock()
+
+# 尝试获取归档锁，已被其他线程或进程持有时返回 None。进程之间用归档目录中锁文件的 flock 互斥，
+# 归档文件本身就在这个目录中，共享归档文件的进程都能看到同一个锁；没有 fcntl 的平台只在进程内互斥
+def try_lock_message_archive():
+    if not _message_archive_lock.acquire(blocking=False):
+        return None
+    try:
+        lock_file = open(os.path.join(app.config['MESSAGE_ARCHIVE_FOLDER'], '.archive.lock'), 'a')
+    except OSError:
+        _message_archive_lock.release()
+        raise
+    try:
+        import fcntl
+    except ImportError:
+        return lock_file
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        _message_archive_lock.release()
+        return None
+    return lock_file
+
+# 释放归档锁，关闭锁文件时 flock 随之释放
+def unlock_message_archive(lock_file):
+    lock_file.close()
+    _message_archive_lock.release()
+
+# 查找最后一条消息早于 cutoff 且没有未读消息的用户，传入 user_ids 时只检查这些用户
+def find_idle_conversations(cutoff, user_ids=None):
+    query = db.session.query(Message.user_id).join(User, User.user_id == Message.user_id)
+    if user_ids is not None:
+        query = query.filter(Message.user_id.in_(user_ids))
+    return [user_id for user_id, in query
+            .group_by(Message.user_id)
+            .having(db.func.max(Message.created_at) < cutoff)
+            .having(db.func.sum(db.case((db.and_(Message.is_admin == False, Message.id > User.last_read_message_id), 1), else_=0)) == 0)]
+
+# 把一组压缩好的片段追加到当天的归档文件并同步到磁盘，返回文件名和每个片段的起始位置
+def append_archive_segments(segments):
+    archive_file = f"messages-{datetime.utcnow().strftime('%Y-%m-%d')}.jsonl.gz"
+    offsets = []
+    with open(os.path.join(app.config['MESSAGE_ARCHIVE_FOLDER'], archive_file), 'ab') as f:
+        for segment in segments:
+            offsets.append(f.tell())
+            f.write(segment)
+        f.flush()
+        os.fsync(f.fileno())
+    return archive_file, offsets
+
+# 归档一批对话：先追加并同步归档文件，再在一个事务中记录片段并删除消息。
+# 提交前中断时归档文件中多出没有记录的片段，消息仍在消息表中，下次重新归档。
+# 在同一个事务中重新确认对话仍然空闲且没有未读消息，只归档早于 cutoff 且 ID 小于 newest_id 的消息，
+# 查找空闲对话之后收到的消息留在消息表中。
+# 消息表中 ID 最大的消息不归档：SQLite 和 MySQL 5.7 按表中现有的最大 ID 分配新 ID，删掉它会让新消息重新使用已归档的 ID
+def archive_conversations(user_ids, newest_id, cutoff, report):
+    segments = []
+    for user_id in find_idle_conversations(cutoff, user_ids):
+        messages = Message.query.filter(
+            Message.user_id == user_id,
+            Message.id < newest_id,
+            Message.created_at < cutoff
+        ).order_by(Message.id).all()
+        if not messages:
+            continue
+        lines = [json.dumps({
+            'id': message.id,
+            'user_id': message.user_id,
+            'content': message.content,
+            'is_admin': message.is_admin,
+            'is_read': message.is_read,
+            'message_type': message.message_type,
+            'created_at': message.created_at.isoformat()
+        }, ensure_ascii=False) for message in messages]
+        media_references = Counter(message.content for message in messages if message.message_type in MEDIA_MESSAGE_TYPES)
+        segments.append((MessageArchive(
+            user_id=user_id,
+            first_message_id=messages[0].id,
+            last_message_id=messages[-1].id,
+            message_count=len(messages),
+            last_message_at=max(message.created_at for message in messages),
+            media_references=json.dumps(media_references)
+        ), gzip.compress(('\n'.join(lines) + '\n').encode())))
+    if not segments:
+        db.session.rollback()
+        return
+    
+    archive_file, offsets = append_archive_segments([data for _, data in segments])
+    for (archive, data), offset in zip(segments, offsets):
+        archive.archive_file = archive_file
+        archive.offset = offset
+        archive.length = len(data)
+        db.session.add(archive)
+        db.session.execute(db.delete(Message).where(
+            Message.user_id == archive.user_id,
+            Message.id <= archive.last_message_id,
+            Message.created_at < cutoff
+        ))
+        report['archived_conversations'] += 1
+        report['archived_messages'] += archive.message_count
+        report['archive_bytes'] += archive.length
+    db.session.commit()
+
+# 归档超过 days 天没有新消息且没有未读消息的对话
+def archive_idle_conversations(report, days=None):
+    days = days if days is not None else app.config['MESSAGE_ARCHIVE_AFTER_DAYS']
+    if days is None:
+        return
+    lock_file = try_lock_message_archive()
+    if lock_file is None:
+        return
+    try:
+        flush_message_queue()
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        user_ids = find_idle_conversations(cutoff)
+        newest_id = db.session.query(db.func.max(Message.id)).scalar()
+        batch_size = app.config['MESSAGE_ARCHIVE_BATCH_SIZE']
+        for i in range(0, len(user_ids), batch_size):
+            archive_conversations(user_ids[i:i + batch_size], newest_id, cutoff, report)
+    finally:
+        unlock_message_archive(lock_file)
+
+# 读取并解压一个归档片段，片段写入后不会改变
+@lru_cache(maxsize=256)
+def read_archive_segment(archive_file, offset, length):
+    with open(os.path.join(app.config['MESSAGE_ARCHIVE_FOLDER'], archive_file), 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+    return tuple(json.loads(line) for line in gzip.decompress(data).splitlines())
+
+# 把归档片段转换为不属于数据库会话的消息对象，和消息表中的消息一样使用
+def load_archived_messages(archive):
+    return [Message(
+        id=item['id'],
+        user_id=item['user_id'],
+        content=item['content'],
+        is_admin=item['is_admin'],
+        is_read=item['is_read'],
+        message_type=item['message_type'],
+        created_at=datetime.fromisoformat(item['created_at'])
+    ) for item in read_archive_segment(archive.archive_file, archive.offset, archive.length)]
+
+# 从归档中读取用户 since_id 之后最早的或 before_id 之前最新的 limit 条消息，只解压需要的片段
+def query_archived_messages(user_id, limit, since_id=None, before_id=None):
+    query = MessageArchive.query.filter_by(user_id=user_id)
+    messages = []
+    if since_id:
+        for archive in query.filter(MessageArchive.last_message_id > since_id).order_by(MessageArchive.last_message_id):
+            messages += [message for message in load_archived_messages(archive) if message.id > since_id]
+            if len(messages) >= limit:
+                break
+        return messages[:limit]
+    
+    if before_id:
+        query = query.filter(MessageArchive.first_message_id < before_id)
+    for archive in query.order_by(MessageArchive.last_message_id.desc()):
+        messages = [message for message in load_archived_messages(archive) if not before_id or message.id < before_id] + messages
+        if len(messages) >= limit:
+            break
+    return messages[-limit:]
+
+# 删除所有片段都已删除的归档文件，保护时间内的文件可能正在归档还未提交
+def sweep_orphaned_archives(report):
+    referenced = {archive_file for archive_file, in db.session.query(MessageArchive.archive_file).distinct()}
+    cutoff_time = time.time() - app.config['UPLOAD_BLOB_GRACE_PERIOD']
+    removed = False
+    for entry in os.scandir(app.config['MESSAGE_ARCHIVE_FOLDER']):
+        if entry.name.startswith('.') or not entry.is_file() or entry.name in referenced:
+            continue
+        if entry.stat().st_mtime >= cutoff_time:
+            continue
+        report['archive_file_bytes'] += remove_path(entry.path)
+        report['archive_files'] += 1
+        removed = True
+        _gc_pause()
+    # 同一天的文件删除后可能重新创建，已解压的片段不能再使用
+    if removed:
+        read_archive_segment.cache_clear()
+
+# 执行一次完整的清理，返回清理报告
+def run_garbage_collection():
+    started = time.monotonic()
+    report = Counter()
+    sweep_upload_sessions(report)
+    sweep_merge_jobs(report)
+    sweep_unreferenced_uploads(report)
+    sweep_orphaned_variants(report)
+    archive_idle_conversations(report)
+    sweep_orphaned_archives(report)
+    report['bytes_reclaimed'] = report['chunk_bytes'] + report['upload_bytes'] + report['variant_bytes'] + report['archive_file_bytes']
+    
+    with _garbage_collector_lock:
+        _garbage_collector['totals'].update(report)
+        _garbage_collector['last_report'] = {
+            **report,
+            'duration': round(time.monotonic() - started, 3),
+            'finished_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        }
+        print(f"Garbage collection reclaimed {report['bytes_reclaimed']} bytes")
+        return _garbage_collector['last_report']
+
+# 后台清理线程：每隔 GC_INTERVAL 秒执行一次
+def _garbage_collector_loop():
+    while True:
+        time.sleep(app.config['GC_INTERVAL'])
+        with app.app_context():
+            try:
+                run_garbage_collection()
+            except Exception as e:
+                print(f'Garbage collection failed: {e}')
+            finally:
+                db.session.remove()
+
+# 收到第一个请求时启动后台清理线程
+@app.before_request
+def start_garbage_collector():
+    if _garbage_collector['thread'] is not None or not app.config['GC_INTERVAL']:
+        return
+    with _garbage_collector_lock:
+        if _garbage_collector['thread'] is None:
+            _garbage_collector['thread'] = threading.Thread(target=_garbage_collector_loop, daemon=True)
+            _garbage_collector['thread'].start()
+
+# 查看清理统计
+@app.route('/admin/gc_stats')
+def gc_stats():
+    if 'admin_logged_in' not in session or not session['admin_logged_in']:
+        return jsonify({'status': 'error', 'message': 'Unauthorized'})
+    
+    with _garbage_collector_lock:
+        return jsonify({
+            'last_run': _garbage_collector['last_report'],
+            'totals': dict(_garbage_collector['totals'])
+        })
+
+# 手动执行一次清理
+@app.cli.command('gc-uploads')
+def gc_uploads_command():
+    report = run_garbage_collection()
+    for key, value in report.items():
+        print(f'{key}: {value}')
+
+# 手动归档长期没有新消息的对话
+@app.cli.command('archive-messages')
+@click.option('--days', type=float, help='Archive conversations idle for more than this many days. Defaults to MESSAGE_ARCHIVE_AFTER_DAYS.')
+def archive_messages_command(days):
+    if days is None and app.config['MESSAGE_ARCHIVE_AFTER_DAYS'] is None:
+        raise click.ClickException('Pass --days or set MESSAGE_ARCHIVE_AFTER_DAYS')
+    report = Counter()
+    archive_idle_conversations(report, days)
+    print(f"Archived {report['archived_conversations']} conversations ({report['archived_messages']} messages, "
+          f"{report['archive_bytes']} bytes compressed), {Message.query.count()} messages left in the message table")
+
 # WebSocket事件处理
 @socketio.on('connect')
 def handle_connect():
@@ -1114,76 +3267,18 @@ def handle_send_message(data):
     is_admin = data.get('is_admin', False)
     
     # 保存消息到数据库
-    message = Message(
-        user_id=user_id,
-        content=content,
-        is_admin=is_admin,
-        message_type=message_type
-    )
-    db.session.add(message)
-    db.session.commit()
+    _, new_message, admin_update = run_blocking(save_chat_message, user_id, content, is_admin, message_type)
     
-    # 发送消息到房间
-    socketio.emit('new_message', {
-        'content': content,
-        'is_admin': is_admin,
-        'message_type': message_type,
-        'created_at': message.created_at.strftime('%Y-%m-%d %H:%M:%S')
-    }, room=user_id)
-    
-    # 通知管理员更新用户列表
-    notify_admin_update()
+    # 发送消息到房间，并通知管理员更新用户列表
+    socketio.emit('new_message', new_message, room=user_id)
+    socketio.emit('admin_update', admin_update, room='admin')
     
     # 如果是用户消息，检查自动回复
     if not is_admin and message_type == 'text':
-        # 检查关键词自动回复
-        auto_replies = AutoReply.query.order_by(AutoReply.order_index).all()
-        reply_sent = False
-        
-        # 先检查常见问题匹配
-        common_questions = CommonQuestion.query.order_by(CommonQuestion.order_index).all()
-        for cq in common_questions:
-            if cq.question == content:
-                admin_reply = Message(
-                    user_id=user_id,
-                    content=cq.content,
-                    is_admin=True,
-                    message_type=cq.message_type
-                )
-                db.session.add(admin_reply)
-                db.session.commit()
-                
-                # 发送自动回复到房间
-                socketio.emit('new_message', {
-                    'content': cq.content,
-                    'is_admin': True,
-                    'message_type': cq.message_type,
-                    'created_at': admin_reply.created_at.strftime('%Y-%m-%d %H:%M:%S')
-                }, room=user_id)
-                reply_sent = True
-                break
-        
-        # 如果没有匹配常见问题，检查关键词自动回复
-        if not reply_sent:
-            for reply in auto_replies:
-                if reply.keyword in content:
-                    admin_reply = Message(
-                        user_id=user_id,
-                        content=reply.content,
-                        is_admin=True,
-                        message_type=reply.message_type
-                    )
-                    db.session.add(admin_reply)
-                    db.session.commit()
-                    
-                    # 发送自动回复到房间
-                    socketio.emit('new_message', {
-                        'content': reply.content,
-                        'is_admin': True,
-                        'message_type': reply.message_type,
-                        'created_at': admin_reply.created_at.strftime('%Y-%m-%d %H:%M:%S')
-                    }, room=user_id)
-                    break
+        reply = run_blocking(save_auto_reply, user_id, content)
+        if reply:
+            # 发送自动回复到房间
+            socketio.emit('new_message', reply, room=user_id)
 
 @socketio.on('disconnect')
 def handle_disconnect():
@@ -1191,31 +3286,69 @@ def handle_disconnect():
 
 # 修改现有的发送消息函数，添加WebSocket通知
 def send_message_with_notification(user_id, content, message_type='text', is_admin=False):
-    message = Message(
-        user_id=user_id,
-        content=content,
-        is_admin=is_admin,
-        message_type=message_type
-    )
-    db.session.add(message)
-    db.session.commit()
+    message, new_message, admin_update = run_blocking(save_chat_message, user_id, content, is_admin, message_type)
     
     # 通过WebSocket发送消息
-    socketio.emit('new_message', {
-        'content': content,
-        'is_admin': is_admin,
-        'message_type': message_type,
-        'created_at': message.created_at.strftime('%Y-%m-%d %H:%M:%S')
-    }, room=user_id)
+    socketio.emit('new_message', new_message, room=user_id)
     
     # 通知管理员更新用户列表
-    notify_admin_update()
+    socketio.emit('admin_update', admin_update, room='admin')
     
     return message
 
-# 通知管理员更新用户列表
-def notify_admin_update():
-    socketio.emit('admin_update', {}, room='admin')
+# 保存消息并生成推送数据：用户房间的新消息和管理员房间的用户行更新。只访问数据库不推送，gevent 模式下在线程池中执行
+def save_chat_message(user_id, content, is_admin=False, message_type='text'):
+    message = save_message(user_id, content, is_admin=is_admin, message_type=message_type)
+    return message, get_new_message_event(message), get_admin_update_event(message)
+
+# 检查自动回复，先检查常见问题匹配，如果没有匹配常见问题，再检查关键词自动回复；匹配时保存回复并返回推送数据
+def save_auto_reply(user_id, content):
+    common_questions, auto_replies = get_auto_reply_engine()
+    reply = common_questions.get(content) or auto_replies.search(content)
+    if not reply:
+        return None
+    admin_reply = save_message(user_id, reply['content'], is_admin=True, message_type=reply['message_type'])
+    return get_new_message_event(admin_reply)
+
+# 生成 new_message 推送数据
+def get_new_message_event(message):
+    return {
+        'id': message.id,
+        'content': message.content,
+        'is_admin': message.is_admin,
+        'message_type': message.message_type,
+        'media': get_message_media(message.content, message.message_type),
+        'created_at': message.created_at.strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+# 生成消息预览文本
+def get_message_preview(content, message_type):
+    if message_type == 'image':
+        return '[图片]'
+    if message_type == 'video':
+        return '[视频]'
+    return content[:50] if content else ''
+
+# 生成管理员用户列表的更新数据，只推送发生变化的那一行用户数据
+def get_admin_update_event(message):
+    return {
+        'user_id': message.user_id,
+        'unread_count': get_unread_count(message.user_id),
+        'latest_message_time': message.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'preview': get_message_preview(message.content, message.message_type)
+    }
+
+# 运行本机消息中转，多个进程配置 SOCKETIO_MESSAGE_QUEUE=local://<socket> 后共享房间消息
+@app.cli.command('message-relay')
+@click.option('--socket', 'path', default='relay.sock', help='Unix socket path to listen on.')
+def message_relay_command(path):
+    relay = MessageRelay(path)
+    print(f'Message relay listening on {path}')
+    try:
+        relay.serve_forever()
+    finally:
+        relay.server_close()
+        os.remove(path)
 
 # 修改admin_send_message函数，使用WebSocket通知
 @app.route('/admin/send_message', methods=['POST'])
@@ -1264,5 +3397,9 @@ def internal_error(error):
     db.session.rollback()
     return 'Internal Server Error', 500
 
+# 性能测试命令在 bench 包中
+from bench import register_bench_commands
+register_bench_commands(app)
+
 if __name__ == '__main__':
     socketio.run(app, debug=True)
\ No newline at end of file
@@ -0,0 +1,71 @@
+# 性能测试命令：通过 flask --app app bench-* 执行，不属于应用代码，由 app.py 在末尾注册。
+# 需要数据库的测试在新建的临时 SQLite 数据库上运行，不会向正在使用的数据库写入测试数据
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+from flask import current_app
+
+# 在临时数据库上重新执行当前命令（加上隐藏的 --run 参数），结束后删除临时目录
+def run_with_temporary_database(extra_env=None):
+    ctx = click.get_current_context()
+    args = [sys.executable, '-m', 'flask', '--app', 'app', ctx.info_name, '--run']
+    for name, value in ctx.params.items():
+        if name != 'run':
+            args += ['--' + name.replace('_', '-'), str(value)]
+    
+    db_dir = tempfile.mkdtemp()
+    env = dict(os.environ,
+               FLASK_SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(db_dir, 'chat.db'),
+               FLASK_RESET_DATABASE_ON_RESTART='false',
+               FLASK_GC_INTERVAL='0',
+               FLASK_MESSAGE_ARCHIVE_FOLDER=os.path.join(db_dir, 'message_archive'),
+               **(extra_env or {}))
+    try:
+        if subprocess.run(args, cwd=current_app.root_path, env=env).returncode != 0:
+            raise click.ClickException(f'{ctx.info_name} failed')
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+# 等待本机端口开始监听，进程提前退出或超时时报错
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                raise click.ClickException(f'server on port {port} did not start')
+            time.sleep(0.1)
+
+# 获取进程占用的物理内存（字节）
+def get_process_rss(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+# 注册所有性能测试命令
+def register_bench_commands(app):
+    from bench.auto_replies import bench_auto_replies_command
+    from bench.captcha import bench_captcha_command
+    from bench.dashboard import bench_dashboard_command
+    from bench.db import bench_db_command
+    from bench.merge import bench_merge_command
+    from bench.pages import bench_pages_command
+    from bench.socketio_scaling import bench_socketio_command
+    from bench.soak import bench_soak_command
+    from bench.user_agents import bench_user_agents_command
+    from bench.write_behind import bench_write_behind_command
+    
+    for command in (bench_auto_replies_command, bench_captcha_command, bench_dashboard_command, bench_db_command,
+                    bench_merge_command, bench_pages_command, bench_socketio_command, bench_soak_command,
+                    bench_user_agents_command, bench_write_behind_command):
+        app.cli.add_command(command)
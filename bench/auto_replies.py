@@ -0,0 +1,92 @@
+import random
+import string
+import time
+
+import click
+from flask.cli import with_appcontext
+
+from bench import run_with_temporary_database
+
+# 对比用的逐条扫描：每条消息都从数据库加载常见问题和自动回复，依次比较问题和检查关键词
+def linear_auto_reply(content):
+    from app import AutoReply, CommonQuestion
+    
+    auto_replies = AutoReply.query.order_by(AutoReply.order_index).all()
+    for cq in CommonQuestion.query.order_by(CommonQuestion.order_index).all():
+        if cq.question == content:
+            return cq.content
+    for reply in auto_replies:
+        if reply.keyword in content:
+            return reply.content
+    return None
+
+# 自动回复性能测试：关键词数逐步增加，测量每条消息的匹配延迟和引擎重建耗时，并与逐条扫描对比
+@click.command('bench-auto-replies')
+@click.option('--keywords', default='10,100,1000,5000', help='Comma separated auto reply keyword counts to measure.')
+@click.option('--questions', default=100, help='Number of common questions.')
+@click.option('--messages', default=1000, help='Messages matched per measurement.')
+@click.option('--run', is_flag=True, hidden=True)
+@with_appcontext
+def bench_auto_replies_command(keywords, questions, messages, run):
+    if not run:
+        run_with_temporary_database()
+        return
+    
+    from app import app, db, AutoReply, CommonQuestion, reset_database, get_auto_reply_engine, invalidate_auto_reply_engine
+    
+    reset_database()
+    rng = random.Random(0)
+    
+    def random_word():
+        return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 8)))
+    
+    db.session.query(AutoReply).delete()
+    db.session.query(CommonQuestion).delete()
+    question_texts = [f'{random_word()} {random_word()}?' for _ in range(questions)]
+    db.session.add_all(CommonQuestion(question=question, content=f'answer {n}', order_index=n)
+                       for n, question in enumerate(question_texts))
+    db.session.commit()
+    
+    keyword_count = 0
+    for target in sorted(int(value) for value in keywords.split(',')):
+        db.session.add_all(AutoReply(keyword=random_word(), content=f'reply {n}', order_index=n)
+                           for n in range(keyword_count, target))
+        db.session.commit()
+        keyword_count = target
+        keyword_texts = [reply.keyword for reply in AutoReply.query.all()]
+        
+        # 一成消息是常见问题，两成包含关键词，其余不匹配
+        samples = []
+        for _ in range(messages):
+            kind = rng.random()
+            if kind < 0.1:
+                samples.append(rng.choice(question_texts))
+            else:
+                words = [random_word() for _ in range(rng.randint(5, 30))]
+                if kind < 0.3:
+                    words.insert(rng.randrange(len(words)), rng.choice(keyword_texts))
+                samples.append(' '.join(words))
+        
+        invalidate_auto_reply_engine()
+        started = time.perf_counter()
+        get_auto_reply_engine()
+        rebuild = time.perf_counter() - started
+        
+        def engine_auto_reply(content):
+            common_questions, auto_replies = get_auto_reply_engine()
+            reply = common_questions.get(content) or auto_replies.search(content)
+            return reply['content'] if reply else None
+        
+        results = {}
+        for name, match in (('engine', engine_auto_reply), ('linear', linear_auto_reply)):
+            started = time.perf_counter()
+            for content in samples:
+                # 每条消息使用新的应用上下文，和处理一个 Socket.IO 事件一样
+                with app.app_context():
+                    match(content)
+            results[name] = (time.perf_counter() - started) / len(samples)
+        
+        with app.app_context():
+            mismatched = sum(engine_auto_reply(content) != linear_auto_reply(content) for content in samples)
+        print(f'{keyword_count} keywords: engine {results["engine"] * 1e6:.1f} us/message '
+              f'(rebuild {rebuild * 1000:.1f} ms), linear {results["linear"] * 1e6:.1f} us/message, {mismatched} mismatched')
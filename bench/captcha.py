@@ -0,0 +1,35 @@
+import time
+
+import click
+from flask.cli import with_appcontext
+
+from bench import run_with_temporary_database
+
+# 验证码性能测试：分别测量渲染速度和从池中取出并返回响应的速度
+@click.command('bench-captcha')
+@click.option('--count', default=500, help='Number of captchas per measurement.')
+@click.option('--run', is_flag=True, hidden=True)
+@with_appcontext
+def bench_captcha_command(count, run):
+    if not run:
+        run_with_temporary_database()
+        return
+    
+    from app import app, reset_database, render_captcha, start_captcha_refiller, _captcha_pool
+    
+    reset_database()
+    started = time.perf_counter()
+    for _ in range(count):
+        render_captcha()
+    print(f'render: {count / (time.perf_counter() - started):.0f} captchas/s')
+    
+    # 先填满池，再通过测试客户端请求，池取空后的请求会当场渲染
+    start_captcha_refiller()
+    while not _captcha_pool.full():
+        time.sleep(0.05)
+    client = app.test_client()
+    served = min(count, _captcha_pool.maxsize)
+    started = time.perf_counter()
+    for _ in range(served):
+        client.get('/admin/captcha')
+    print(f'serve from pool: {served / (time.perf_counter() - started):.0f} captchas/s')
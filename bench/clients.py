@@ -0,0 +1,127 @@
+# 性能测试用的 Socket.IO 客户端
+import asyncio
+import base64
+import json
+import os
+import threading
+from collections import Counter
+
+# 性能测试用的 Socket.IO 客户端：直接使用 Engine.IO 的 WebSocket 传输，收到 Engine.IO ping 时回复 pong
+class BenchSocketClient:
+    def __init__(self, url):
+        from simple_websocket import Client
+        self.ws = Client.connect(url.replace('http://', 'ws://') + '/socket.io/?EIO=4&transport=websocket')
+        self.counts = Counter()
+        self.condition = threading.Condition()
+        self.ws.receive()  # Engine.IO open 包
+        self.ws.send('40')
+        self.wait_for_packet('40')
+        self.thread = threading.Thread(target=self._receive_loop, daemon=True)
+        self.thread.start()
+    
+    def wait_for_packet(self, prefix):
+        while not self.ws.receive().startswith(prefix):
+            pass
+    
+    def _receive_loop(self):
+        while True:
+            try:
+                packet = self.ws.receive()
+            except Exception:
+                return
+            if packet == '2':
+                self.ws.send('3')
+            elif packet.startswith('42'):
+                event = json.loads(packet[2:])[0]
+                with self.condition:
+                    self.counts[event] += 1
+                    self.condition.notify_all()
+    
+    def emit(self, event, data=None):
+        self.ws.send('42' + json.dumps([event] if data is None else [event, data]))
+    
+    def wait_for(self, event, count, timeout):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.counts[event] >= count, timeout)
+    
+    def close(self):
+        self.ws.close()
+
+# 性能测试用的 asyncio WebSocket 客户端，单个进程可以维持上万个 Socket.IO 连接
+class AsyncBenchSocket:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+    
+    @classmethod
+    async def connect(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((f'GET /socket.io/?EIO=4&transport=websocket HTTP/1.1\r\nHost: {host}:{port}\r\n'
+                      f'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                      f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n').encode())
+        response = await reader.readuntil(b'\r\n\r\n')
+        if b' 101 ' not in response.split(b'\r\n', 1)[0]:
+            writer.close()
+            raise ConnectionError(response.split(b'\r\n', 1)[0].decode())
+        client = cls(reader, writer)
+        await client.receive()  # Engine.IO open 包
+        await client.send('40')
+        while not (await client.receive()).startswith('40'):
+            pass
+        return client
+    
+    async def _send_frame(self, opcode, payload):
+        header = bytearray([0x80 | opcode])
+        if len(payload) < 126:
+            header.append(0x80 | len(payload))
+        elif len(payload) < 65536:
+            header.append(0x80 | 126)
+            header += len(payload).to_bytes(2, 'big')
+        else:
+            header.append(0x80 | 127)
+            header += len(payload).to_bytes(8, 'big')
+        mask = os.urandom(4)
+        masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        self.writer.write(bytes(header) + mask + masked)
+        await self.writer.drain()
+    
+    async def send(self, text):
+        await self._send_frame(0x1, text.encode())
+    
+    # 返回下一个 Engine.IO 包，自动回复 WebSocket ping 和 Engine.IO ping
+    async def receive(self):
+        while True:
+            head = await self.reader.readexactly(2)
+            opcode = head[0] & 0x0f
+            length = head[1] & 0x7f
+            if length == 126:
+                length = int.from_bytes(await self.reader.readexactly(2), 'big')
+            elif length == 127:
+                length = int.from_bytes(await self.reader.readexactly(8), 'big')
+            payload = await self.reader.readexactly(length)
+            if opcode == 0x8:
+                raise ConnectionError('WebSocket closed')
+            if opcode == 0x9:
+                await self._send_frame(0xA, payload)
+                continue
+            packet = payload.decode()
+            if packet == '2':
+                await self.send('3')
+                continue
+            return packet
+    
+    async def emit(self, event, data=None):
+        await self.send('42' + json.dumps([event] if data is None else [event, data]))
+    
+    # 等待指定事件，返回事件数据
+    async def wait_for(self, event):
+        while True:
+            packet = await self.receive()
+            if packet.startswith('42'):
+                payload = json.loads(packet[2:])
+                if payload[0] == event:
+                    return payload[1] if len(payload) > 1 else None
+    
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,75 @@
+import time
+
+import click
+from flask.cli import with_appcontext
+
+from bench import run_with_temporary_database
+
+# 对比用的逐个用户查询：每个用户各查询一次未读数和最新消息
+def per_user_dashboard_data():
+    from app import Message, User, detect_device_type
+    
+    user_data = []
+    for user in User.query.all():
+        unread_count = Message.query.filter(Message.user_id == user.user_id, Message.is_admin == False,
+                                            Message.id > user.last_read_message_id).count()
+        latest_message = Message.query.filter_by(user_id=user.user_id).order_by(Message.created_at.desc()).first()
+        user_data.append({
+            'user': user,
+            'unread_count': unread_count,
+            'device_type': detect_device_type(user.user_agent),
+            'latest_message_time': latest_message.created_at if latest_message else user.created_at
+        })
+    user_data.sort(key=lambda x: x['latest_message_time'], reverse=True)
+    return user_data
+
+# 管理员用户列表性能测试：用户数逐步增加，分别测量分组查询和逐个用户查询的 SQL 语句数和耗时
+@click.command('bench-dashboard')
+@click.option('--users', default='100,1000,5000', help='Comma separated user counts to measure.')
+@click.option('--messages', default=10, help='Messages per user.')
+@click.option('--repeat', default=3, help='Measurements per user count.')
+@click.option('--run', is_flag=True, hidden=True)
+@with_appcontext
+def bench_dashboard_command(users, messages, repeat, run):
+    if not run:
+        run_with_temporary_database()
+        return
+    
+    from app import app, db, Message, User, reset_database, generate_user_id, get_dashboard_user_data
+    
+    reset_database()
+    statements = [0]
+    
+    def count_statement(*args):
+        statements[0] += 1
+    
+    db.event.listen(db.engine, 'before_cursor_execute', count_statement)
+    user_agents = [
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Mobile/15E148 Safari/604.1',
+        'Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36',
+    ]
+    user_count = 0
+    for target in sorted(int(value) for value in users.split(',')):
+        user_ids = [generate_user_id() for _ in range(target - user_count)]
+        db.session.execute(db.insert(User), [
+            {'user_id': user_id, 'user_agent': user_agents[n % len(user_agents)]} for n, user_id in enumerate(user_ids)
+        ])
+        db.session.execute(db.insert(Message), [
+            {'user_id': user_id, 'content': f'bench {n}', 'is_admin': n % 2 == 1, 'is_read': False, 'message_type': 'text'}
+            for n in range(messages) for user_id in user_ids
+        ])
+        db.session.commit()
+        user_count = target
+        
+        for name, load in (('grouped', get_dashboard_user_data), ('per-user', per_user_dashboard_data)):
+            timings = []
+            for _ in range(repeat):
+                # 每次使用新的应用上下文，和处理一个请求一样
+                with app.app_context():
+                    statements[0] = 0
+                    started = time.perf_counter()
+                    load()
+                    timings.append(time.perf_counter() - started)
+            print(f'{user_count} users, {name}: {statements[0]} queries, '
+                  f'best {min(timings) * 1000:.1f} ms, mean {sum(timings) / len(timings) * 1000:.1f} ms')
@@ -0,0 +1,113 @@
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+# 在 bench-db 的子进程中循环读或写，直到测试时间结束；每次操作使用独立的应用上下文，和处理一个请求一样
+def run_db_bench_role(role, duration, start_at):
+    from sqlalchemy.exc import OperationalError
+    from app import app, db, User, save_chat_message, get_dashboard_user_data, query_message_page
+    
+    user_ids = [user_id for user_id, in db.session.query(User.user_id).filter_by(user_agent='bench-db')]
+    db.session.remove()
+    latencies = []
+    failed = 0
+    time.sleep(max(start_at - time.time(), 0))
+    deadline = start_at + duration
+    while time.time() < deadline:
+        user_id = random.choice(user_ids)
+        started = time.perf_counter()
+        with app.app_context():
+            try:
+                if role == 'writer':
+                    save_chat_message(user_id, 'bench-db')
+                else:
+                    get_dashboard_user_data()
+                    query_message_page(user_id)
+            except OperationalError:
+                db.session.rollback()
+                failed += 1
+                continue
+        latencies.append(time.perf_counter() - started)
+    return {'latencies': latencies, 'failed': failed}
+
+# 数据库并发读写测试：写进程按聊天消息的流程保存消息并统计未读数，读进程按管理员后台的流程查询用户列表和一页消息。
+# 每种配置使用新的临时数据库，所有进程在同一时刻开始；写入测试数据的子进程只在临时数据库上运行
+@click.command('bench-db')
+@click.option('--profiles', default='off,on', help='Comma separated SQLITE_TUNING values to compare.')
+@click.option('--writers', default=4, help='Number of writer processes.')
+@click.option('--readers', default=4, help='Number of reader processes.')
+@click.option('--users', default=200, help='Number of users seeded before the run.')
+@click.option('--seed-messages', default=50, help='Messages per user seeded before the run.')
+@click.option('--duration', default=10.0, help='Seconds each process runs.')
+@click.option('--role', type=click.Choice(['seed', 'writer', 'reader']), hidden=True)
+@click.option('--start-at', type=float, hidden=True)
+@with_appcontext
+def bench_db_command(profiles, writers, readers, users, seed_messages, duration, role, start_at):
+    if role and not os.environ.get('BENCH_TEMPORARY_DATABASE'):
+        raise click.ClickException('--role is only used by bench-db on its temporary databases')
+    if role == 'seed':
+        from app import db, Message, User, reset_database, generate_user_id
+        
+        reset_database()
+        user_ids = [generate_user_id() for _ in range(users)]
+        db.session.add_all(User(user_id=user_id, user_agent='bench-db') for user_id in user_ids)
+        db.session.execute(db.insert(Message), [
+            {'user_id': user_id, 'content': f'seed {n}', 'is_admin': n % 2 == 1, 'is_read': False, 'message_type': 'text'}
+            for n in range(seed_messages) for user_id in user_ids
+        ])
+        db.session.commit()
+        return
+    if role:
+        print(json.dumps(run_db_bench_role(role, duration, start_at)))
+        return
+    
+    command = [sys.executable, '-m', 'flask', '--app', 'app', 'bench-db']
+    for profile in profiles.split(','):
+        db_dir = tempfile.mkdtemp()
+        env = dict(os.environ,
+                   BENCH_TEMPORARY_DATABASE='1',
+                   FLASK_SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(db_dir, 'chat.db'),
+                   FLASK_SQLITE_TUNING='true' if profile == 'on' else 'false',
+                   FLASK_RESET_DATABASE_ON_RESTART='false',
+                   FLASK_GC_INTERVAL='0',
+                   FLASK_MESSAGE_ARCHIVE_FOLDER=os.path.join(db_dir, 'message_archive'))
+        try:
+            subprocess.run(command + ['--role', 'seed', '--users', str(users), '--seed-messages', str(seed_messages)],
+                           cwd=current_app.root_path, env=env, stdout=subprocess.DEVNULL, check=True)
+            # 留出导入应用的时间，所有进程同时开始读写
+            start_at = time.time() + 5
+            processes = [
+                (process_role, subprocess.Popen(command + ['--role', process_role, '--duration', str(duration), '--start-at', str(start_at)],
+                                                cwd=current_app.root_path, env=env, stdout=subprocess.PIPE, text=True))
+                for process_role in ['writer'] * writers + ['reader'] * readers
+            ]
+            results = {'writer': {'latencies': [], 'failed': 0}, 'reader': {'latencies': [], 'failed': 0}}
+            for process_role, process in processes:
+                output, _ = process.communicate()
+                if process.returncode != 0:
+                    raise click.ClickException(f'{process_role} process exited with {process.returncode}')
+                result = json.loads(output.splitlines()[-1])
+                results[process_role]['latencies'] += result['latencies']
+                results[process_role]['failed'] += result['failed']
+        finally:
+            shutil.rmtree(db_dir, ignore_errors=True)
+        
+        for process_role, name in (('writer', 'writes'), ('reader', 'reads')):
+            latencies = sorted(results[process_role]['latencies'])
+            failed = results[process_role]['failed']
+            if not latencies:
+                print(f'SQLITE_TUNING={profile}: no {name} completed, {failed} failed')
+                continue
+            print(f'SQLITE_TUNING={profile}: {len(latencies) / duration:.0f} {name}/s, '
+                  f'latency p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, '
+                  f'p99 {latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000:.1f} ms, '
+                  f'max {latencies[-1] * 1000:.1f} ms, {failed} failed')
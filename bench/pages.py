@@ -0,0 +1,38 @@
+import time
+
+import click
+from flask.cli import with_appcontext
+
+from bench import run_with_temporary_database
+
+# 聊天页面性能测试：分别测量首次访问（新会话，创建用户并发送打招呼语句）和再次访问的延迟
+@click.command('bench-pages')
+@click.option('--count', default=200, help='Number of requests per measurement.')
+@click.option('--run', is_flag=True, hidden=True)
+@with_appcontext
+def bench_pages_command(count, run):
+    if not run:
+        run_with_temporary_database()
+        return
+    
+    from app import app, reset_database, get_system_setting
+    
+    reset_database()
+    path = get_system_setting('chat_path', '/')
+    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/120.0 Safari/537.36'}
+    
+    def measure(name, clients):
+        latencies = []
+        for client in clients:
+            started = time.perf_counter()
+            response = client.get(path, headers=headers)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                raise click.ClickException(f'{name}: GET {path} returned {response.status_code}')
+        latencies.sort()
+        print(f'{name}: mean {sum(latencies) / len(latencies):.2f} ms, '
+              f'p50 {latencies[len(latencies) // 2]:.2f} ms, p95 {latencies[int(len(latencies) * 0.95)]:.2f} ms')
+    
+    clients = [app.test_client() for _ in range(count)]
+    measure('first visit', clients)
+    measure('return visit', [clients[i % len(clients)] for i in range(count)])
@@ -0,0 +1,126 @@
+import asyncio
+import random
+import subprocess
+import sys
+import time
+
+import click
+from flask.cli import with_appcontext
+
+from bench import get_process_rss, run_with_temporary_database, wait_for_port
+from bench.clients import AsyncBenchSocket
+
+# 长连接压力测试：启动一个服务进程，先建立大量空闲连接测量每个连接占用的内存，
+# 再让活跃客户端按固定间隔发送消息，测量从发送到收到自己消息推送的延迟
+@click.command('bench-soak')
+@click.option('--server', type=click.Choice(['gevent', 'threading']), default='gevent', help='Server mode to start.')
+@click.option('--idle', default=10000, help='Number of idle connections.')
+@click.option('--active', default=500, help='Number of clients sending messages.')
+@click.option('--messages', default=10, help='Messages per active client.')
+@click.option('--interval', default=5.0, help='Seconds between messages of one active client.')
+@click.option('--port', default=5200, help='Port of the server.')
+@click.option('--run', is_flag=True, hidden=True)
+@with_appcontext
+def bench_soak_command(server, idle, active, messages, interval, port, run):
+    if not run:
+        run_with_temporary_database()
+        return
+    
+    from app import app, db, User, reset_database, generate_user_id
+    
+    reset_database()
+    if server == 'gevent':
+        command = [sys.executable, 'server.py', '--port', str(port)]
+    else:
+        command = [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port)]
+    user_ids = [generate_user_id() for _ in range(active)]
+    db.session.add_all(User(user_id=user_id, user_agent='bench-soak') for user_id in user_ids)
+    db.session.commit()
+    
+    # 建立连接，返回成功的连接和失败数
+    async def connect_all(count, concurrency=100):
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def connect_one():
+            async with semaphore:
+                return await asyncio.wait_for(AsyncBenchSocket.connect('127.0.0.1', port), 30)
+        
+        results = await asyncio.gather(*(connect_one() for _ in range(count)), return_exceptions=True)
+        clients = [result for result in results if isinstance(result, AsyncBenchSocket)]
+        return clients, count - len(clients)
+    
+    async def keep_alive(client):
+        try:
+            while True:
+                await client.receive()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+    
+    async def run_clients(pid):
+        warmup = await AsyncBenchSocket.connect('127.0.0.1', port)
+        await asyncio.sleep(1)
+        rss_before = get_process_rss(pid)
+        
+        started = time.perf_counter()
+        idle_clients, idle_failed = await connect_all(idle)
+        connect_time = time.perf_counter() - started
+        idle_tasks = [asyncio.create_task(keep_alive(client)) for client in idle_clients]
+        await asyncio.sleep(2)
+        rss_after = get_process_rss(pid)
+        print(f'{server}: {len(idle_clients)} idle connections in {connect_time:.1f} s ({idle_failed} failed), '
+              f'RSS {rss_before / 1048576:.1f} MB -> {rss_after / 1048576:.1f} MB '
+              f'({(rss_after - rss_before) / max(len(idle_clients), 1) / 1024:.1f} KB per connection)')
+        
+        active_clients, active_failed = await connect_all(active)
+        if active_failed:
+            print(f'{active_failed} active clients failed to connect')
+        user_ids_connected = user_ids[:len(active_clients)]
+        for client, user_id in zip(active_clients, user_ids_connected):
+            await client.emit('join_room', {'user_id': user_id})
+        await asyncio.sleep(1)
+        
+        latencies = []
+        failed = 0
+        
+        async def send_messages(client, user_id):
+            nonlocal failed
+            # 错开各客户端的发送时间
+            await asyncio.sleep(random.random() * interval)
+            for n in range(messages):
+                content = f'soak {n}'
+                sent = time.perf_counter()
+                await client.emit('send_message', {'user_id': user_id, 'content': content, 'message_type': 'text'})
+                try:
+                    while (await asyncio.wait_for(client.wait_for('new_message'), 30))['content'] != content:
+                        pass
+                    latencies.append(time.perf_counter() - sent)
+                except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+                    failed += 1
+                    return
+                await asyncio.sleep(max(interval - (time.perf_counter() - sent), 0))
+        
+        started = time.perf_counter()
+        await asyncio.gather(*(send_messages(client, user_id) for client, user_id in zip(active_clients, user_ids_connected)))
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        if latencies:
+            print(f'{len(active_clients)} active clients: {len(latencies)} messages in {elapsed:.1f} s ({len(latencies) / elapsed:.0f} msg/s), '
+                  f'latency p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, '
+                  f'p99 {latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000:.1f} ms, '
+                  f'max {latencies[-1] * 1000:.1f} ms, {failed} failed')
+        else:
+            print(f'{len(active_clients)} active clients: no messages delivered, {failed} failed')
+        
+        for task in idle_tasks:
+            task.cancel()
+        for client in idle_clients + active_clients + [warmup]:
+            client.close()
+    
+    # 服务进程继承临时数据库的环境变量
+    process = subprocess.Popen(command, cwd=app.root_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port, process)
+        asyncio.run(run_clients(process.pid))
+    finally:
+        process.terminate()
+        process.wait()
@@ -0,0 +1,125 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import click
+from flask.cli import with_appcontext
+
+from bench import run_with_temporary_database, wait_for_port
+from bench.clients import BenchSocketClient
+
+# Socket.IO 多进程扩展测试：启动本机消息中转和若干个工作进程，客户端轮流连接到各进程，
+# 分别测量连接速度、从外部进程向所有用户房间推送消息的速度，以及客户端发送消息（写入数据库、推送到用户房间和管理员房间）的速度
+@click.command('bench-socketio')
+@click.option('--workers', default='1,2,4', help='Comma separated worker counts to measure.')
+@click.option('--clients', default=100, help='Number of user clients.')
+@click.option('--messages', default=20, help='Messages per client in each phase.')
+@click.option('--port', default=5100, help='Port of the first worker.')
+@click.option('--timeout', default=30, help='Seconds to wait for the broadcast phase and for each sent message.')
+@click.option('--run', is_flag=True, hidden=True)
+@with_appcontext
+def bench_socketio_command(workers, clients, messages, port, timeout, run):
+    if not run:
+        run_with_temporary_database()
+        return
+    
+    from app import app, db, User, reset_database, generate_user_id, MessageRelay, LocalSocketManager
+    
+    reset_database()
+    relay_dir = tempfile.mkdtemp()
+    relay_path = os.path.join(relay_dir, 'relay.sock')
+    relay = MessageRelay(relay_path)
+    threading.Thread(target=relay.serve_forever, daemon=True).start()
+    queue_url = 'local://' + relay_path
+    publisher = LocalSocketManager(queue_url, write_only=True)
+    
+    # 工作进程继承临时数据库的环境变量
+    env = dict(os.environ, FLASK_SOCKETIO_MESSAGE_QUEUE=queue_url)
+    
+    user_ids = [generate_user_id() for _ in range(clients)]
+    db.session.add_all(User(user_id=user_id, user_agent='bench-socketio') for user_id in user_ids)
+    db.session.commit()
+    
+    def wait_all(sockets, event, count, phase):
+        deadline = time.monotonic() + timeout
+        for client in sockets:
+            if not client.wait_for(event, count, max(deadline - time.monotonic(), 0)):
+                raise click.ClickException(f'{phase}: timed out waiting for {event}')
+    
+    try:
+        for worker_count in [int(value) for value in workers.split(',')]:
+            urls = [f'http://127.0.0.1:{port + i}' for i in range(worker_count)]
+            processes = [
+                subprocess.Popen([sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port + i)],
+                                 cwd=app.root_path, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                for i in range(worker_count)
+            ]
+            admin = None
+            sockets = []
+            try:
+                for i in range(worker_count):
+                    wait_for_port(port + i, processes[i])
+                
+                # 管理员连接到最后一个进程，用户房间的消息需要经过消息中转才能到达
+                admin = BenchSocketClient(urls[-1])
+                admin.emit('join_admin_room')
+                started = time.perf_counter()
+                for i, user_id in enumerate(user_ids):
+                    client = BenchSocketClient(urls[i % worker_count])
+                    client.emit('join_room', {'user_id': user_id})
+                    sockets.append(client)
+                connect_time = time.perf_counter() - started
+                time.sleep(0.5)  # 等待加入房间的事件处理完
+                
+                started = time.perf_counter()
+                for n in range(messages):
+                    for user_id in user_ids:
+                        publisher.emit('new_message', {'content': f'broadcast {n}', 'is_admin': True, 'message_type': 'text'}, room=user_id)
+                wait_all(sockets, 'new_message', messages, 'broadcast')
+                broadcast_time = time.perf_counter() - started
+                
+                # 每个客户端收到自己消息的推送后再发送下一条，超时未收到的计为失败（例如数据库写入出错）
+                failed = Counter()
+                
+                def send_messages(client, user_id):
+                    received = messages
+                    for n in range(messages):
+                        client.emit('send_message', {'user_id': user_id, 'content': f'bench {n}', 'message_type': 'text'})
+                        if client.wait_for('new_message', received + 1, timeout):
+                            received += 1
+                        else:
+                            failed[user_id] += 1
+                
+                started = time.perf_counter()
+                senders = [threading.Thread(target=send_messages, args=(client, user_id)) for client, user_id in zip(sockets, user_ids)]
+                for sender in senders:
+                    sender.start()
+                for sender in senders:
+                    sender.join()
+                total = messages * clients
+                delivered = total - sum(failed.values())
+                admin.wait_for('admin_update', delivered, timeout)
+                send_time = time.perf_counter() - started
+                
+                print(f'{worker_count} worker(s): {clients} clients connected in {connect_time:.2f} s ({clients / connect_time:.0f}/s), '
+                      f'broadcast {total / broadcast_time:.0f} msg/s, '
+                      f'send {delivered / send_time:.0f} msg/s ({total - delivered} failed, '
+                      f'{admin.counts["admin_update"]}/{delivered} admin updates)')
+            finally:
+                if admin is not None:
+                    admin.close()
+                for client in sockets:
+                    client.close()
+                for process in processes:
+                    process.terminate()
+                for process in processes:
+                    process.wait()
+    finally:
+        relay.shutdown()
+        relay.server_close()
+        shutil.rmtree(relay_dir, ignore_errors=True)
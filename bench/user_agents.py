@@ -0,0 +1,111 @@
+import random
+import time
+
+import click
+from flask.cli import with_appcontext
+
+from bench import run_with_temporary_database
+
+# 真实浏览器、应用内浏览器、爬虫和脚本的 User Agent
+USER_AGENT_CORPUS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Safari/605.1.15',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0',
+    'Mozilla/5.0 (X11; CrOS x86_64 14541.0.0) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_2 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148 MicroMessenger/8.0.44(0x18002c2f) NetType/WIFI Language/zh_CN',
+    'Mozilla/5.0 (iPad; CPU OS 17_2 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.6099.144 Mobile Safari/537.36',
+    'Mozilla/5.0 (Linux; Android 13; SM-S918B) AppleWebKit/537.36 (KHTML, like Gecko) SamsungBrowser/23.0 Chrome/115.0.0.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (Linux; Android 12; M2012K11AC Build/SKQ1.211006.001; wv) AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 Chrome/107.0.5304.141 Mobile Safari/537.36 XWEB/5235 MMWEBSDK/20230805 MicroMessenger/8.0.42.2460(0x28002A35) WeChat/arm64 Weixin NetType/WIFI Language/zh_CN ABI/arm64',
+    'Mozilla/5.0 (Linux; U; Android 10; zh-cn; MI 9 Build/QKQ1.190825.002) AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 Chrome/100.0.4896.127 Mobile Safari/537.36 XiaoMi/MiuiBrowser/17.5.40',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)',
+    'Mozilla/5.0 (compatible; Baiduspider/2.0; +http://www.baidu.com/search/spider.html)',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) HeadlessChrome/120.0.0.0 Safari/537.36',
+    'curl/8.4.0',
+    'python-requests/2.31.0',
+    'Wget/1.21.4',
+    'Go-http-client/1.1',
+]
+
+# 被阻止的关键词中包含的常见爬虫和脚本标识，其余用生成的关键词补足
+BLOCKED_KEYWORDS = ['bot', 'spider', 'crawler', 'curl', 'wget', 'python-requests', 'go-http-client', 'headlesschrome']
+
+# 对比用的逐个关键词扫描：每次请求重新拆分设置，再逐个检查关键词和设备类型
+def linear_classify(user_agent):
+    from app import get_system_setting
+    
+    user_agent = user_agent.lower()
+    for keyword in get_system_setting('blocked_user_agents', '').split(','):
+        keyword = keyword.strip().lower()
+        if keyword and keyword in user_agent:
+            return False, None
+    if any(device in user_agent for device in ['mobile', 'android', 'iphone', 'ipad', 'ipod', 'blackberry', 'windows phone']):
+        for device, name in (('android', 'Android手机'), ('iphone', 'iPhone'), ('ipad', 'iPad')):
+            if device in user_agent:
+                return True, name
+        return True, '移动设备'
+    for device, name in (('windows', 'Windows桌面'), ('macintosh', 'Mac桌面'), ('linux', 'Linux桌面'), ('chromeos', 'Chrome OS')):
+        if device in user_agent:
+            return True, name
+    return True, '其他设备'
+
+# User Agent 分类微基准：在真实 User Agent 上分别测量编译后的匹配（首次和缓存命中）和逐个关键词扫描的速度
+@click.command('bench-user-agents')
+@click.option('--keywords', default='10,100,1000', help='Comma separated blocked keyword counts to measure.')
+@click.option('--requests', default=100000, help='User agents classified per measurement.')
+@click.option('--distinct', default=2000, help='Number of distinct user agents among the requests.')
+@click.option('--run', is_flag=True, hidden=True)
+@with_appcontext
+def bench_user_agents_command(keywords, requests, distinct, run):
+    if not run:
+        run_with_temporary_database()
+        return
+    
+    from app import (reset_database, update_system_setting, is_valid_user_agent, detect_device_type,
+                     is_blocked_user_agent, compile_blocked_user_agents)
+    
+    reset_database()
+    update_system_setting('enable_user_agent_filter', 'true')
+    # 在语料后加上不同的版本号得到 distinct 个不同的 User Agent，请求中同一个 User Agent 会反复出现
+    variants = [f'{USER_AGENT_CORPUS[n % len(USER_AGENT_CORPUS)]} Build/{n}' for n in range(distinct)]
+    samples = [random.choice(variants) for _ in range(requests)]
+    
+    def compiled_classify(user_agent):
+        return is_valid_user_agent(user_agent), detect_device_type(user_agent)
+    
+    for count in [int(value) for value in keywords.split(',')]:
+        blocked = BLOCKED_KEYWORDS + [f'blocked-agent-{n}' for n in range(max(count - len(BLOCKED_KEYWORDS), 0))]
+        update_system_setting('blocked_user_agents', ','.join(blocked[:count]))
+        for cached in (is_blocked_user_agent, detect_device_type, compile_blocked_user_agents):
+            cached.cache_clear()
+        
+        # 缓存为空时每个不同的 User Agent 都要匹配一次
+        started = time.perf_counter()
+        for user_agent in variants:
+            compiled_classify(user_agent)
+        cold = (time.perf_counter() - started) / len(variants)
+        
+        started = time.perf_counter()
+        for user_agent in samples:
+            compiled_classify(user_agent)
+        warm = (time.perf_counter() - started) / len(samples)
+        
+        started = time.perf_counter()
+        for user_agent in samples:
+            linear_classify(user_agent)
+        linear = (time.perf_counter() - started) / len(samples)
+        
+        # 被阻止时不比较设备类型
+        mismatched = 0
+        for user_agent in variants:
+            (valid, device_type), (expected_valid, expected_device_type) = compiled_classify(user_agent), linear_classify(user_agent)
+            if valid != expected_valid or (valid and device_type != expected_device_type):
+                mismatched += 1
+        print(f'{count} keywords: compiled {cold * 1e6:.1f} us first match, {warm * 1e6:.2f} us cached, '
+              f'linear {linear * 1e6:.1f} us, {mismatched} mismatched')
@@ -0,0 +1,67 @@
+import threading
+import time
+
+import click
+from flask.cli import with_appcontext
+
+from bench import run_with_temporary_database
+
+# 消息写入负载测试：多个线程按发送消息的流程保存消息并生成推送数据，对比同步提交和异步批量写入的吞吐量和延迟
+@click.command('bench-write-behind')
+@click.option('--threads', default=4, help='Number of sending threads.')
+@click.option('--users', default=100, help='Number of users sending messages.')
+@click.option('--messages', default=2000, help='Messages sent in each mode.')
+@click.option('--run', is_flag=True, hidden=True)
+@with_appcontext
+def bench_write_behind_command(threads, users, messages, run):
+    if not run:
+        run_with_temporary_database()
+        return
+    
+    from app import app, db, Message, User, reset_database, generate_user_id, save_chat_message, flush_message_queue
+    
+    reset_database()
+    user_ids = [generate_user_id() for _ in range(users)]
+    db.session.add_all(User(user_id=user_id, user_agent='bench-write-behind') for user_id in user_ids)
+    db.session.commit()
+    
+    for write_behind in (False, True):
+        app.config['MESSAGE_WRITE_BEHIND'] = write_behind
+        latencies = []
+        failed = [0]
+        
+        def send_messages(worker):
+            for n in range(worker, messages, threads):
+                started = time.perf_counter()
+                # 每条消息使用新的应用上下文，和处理一个 Socket.IO 事件一样
+                with app.app_context():
+                    try:
+                        save_chat_message(user_ids[n % users], f'bench {n}')
+                    except Exception:
+                        db.session.rollback()
+                        failed[0] += 1
+                        continue
+                latencies.append(time.perf_counter() - started)
+        
+        count_before = Message.query.count()
+        db.session.remove()
+        started = time.perf_counter()
+        workers = [threading.Thread(target=send_messages, args=(worker,)) for worker in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        # 异步写入时等消息全部写入数据库后再计时结束
+        flush_message_queue()
+        elapsed = time.perf_counter() - started
+        stored = Message.query.count() - count_before
+        
+        latencies.sort()
+        mode = 'write-behind' if write_behind else 'synchronous'
+        if not latencies:
+            print(f'{mode}: no messages sent, {failed[0]} failed')
+            continue
+        print(f'{mode}: {stored / elapsed:.0f} msg/s stored, '
+              f'send latency p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, '
+              f'p99 {latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000:.2f} ms, '
+              f'{stored}/{messages} stored, {failed[0]} failed')
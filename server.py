@@ -0,0 +1,17 @@
+# 生产环境入口：使用 gevent 协程处理 WebSocket 长连接，每个连接只占用一个协程而不是一个线程
+# 必须在导入其他模块之前打补丁，app.py 检测到补丁后使用 gevent 模式
+from gevent import monkey
+monkey.patch_all()
+
+import click
+from app import app, socketio
+
+@click.command()
+@click.option('--host', default='127.0.0.1', help='Address to listen on.')
+@click.option('--port', default=5000, help='Port to listen on.')
+@click.option('--access-log/--no-access-log', default=False, help='Log every request.')
+def main(host, port, access_log):
+    socketio.run(app, host=host, port=port, log_output=access_log)
+
+if __name__ == '__main__':
+    main()